@@ -9,7 +9,10 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.exceptions import TelegramBadRequest # 👈 Buni qo'shish kerak!
 from config import ADMIN_IDS, DEFAULT_UNIT
 import database # Neon DB bilan ishlash uchun
+import asyncio
 import logging
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
 
 logging.basicConfig(level=logging.INFO)
 
@@ -53,6 +56,89 @@ def get_agent_management_buttons(agent_name: str) -> types.InlineKeyboardMarkup:
         ]
     )
 
+# Telegram xabar chegarasi 4096 belgi; sarlavha va Markdown belgilari uchun zaxira qoldiriladi
+TELEGRAM_PAGE_LIMIT = 3800
+
+def build_text_pages(blocks: List[Tuple[str, List[str]]], limit: int = TELEGRAM_PAGE_LIMIT) -> List[str]:
+    """
+    (sarlavha, monospace qatorlar) bloklarini xabar chegarasiga sig'adigan sahifalarga bo'ladi.
+    Sig'magan blok keyingi sahifada sarlavhasi bilan davom etadi; har bir ``` bloki sahifa ichida yopiladi.
+    """
+    pages, current = [], ""
+    for title, rows in blocks:
+        remaining = list(rows)
+        while True:
+            header = f"{title}\n```\n"
+            size = len(current) + len(header) + len("\n```\n")
+            body = []
+            while remaining and size + len(remaining[0]) + 1 <= limit:
+                size += len(remaining[0]) + 1
+                body.append(remaining.pop(0))
+            if not body and remaining:
+                if current:
+                    # Joriy sahifada joy qolmadi - blok yangi sahifadan boshlanadi
+                    pages.append(current)
+                    current = ""
+                    continue
+                # Bitta qatorning o'zi chegaradan uzun (amalda bo'lmaydi) - qisqartiriladi
+                body.append(remaining.pop(0)[:limit - len(header) - 5])
+            current += header + "\n".join(body) + "\n```\n"
+            if not remaining:
+                break
+            pages.append(current)
+            current = ""
+    if current:
+        pages.append(current)
+    return pages or [""]
+
+def get_page_nav_row(prefix: str, page: int, total_pages: int) -> List[types.InlineKeyboardButton]:
+    """Sahifalar orasida yurish tugmalari qatori (callback_data: "<prefix>:<sahifa>")."""
+    row = []
+    if page > 0:
+        row.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}:{page - 1}"))
+    row.append(types.InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data=f"{prefix}:{page}"))
+    if page < total_pages - 1:
+        row.append(types.InlineKeyboardButton(text="➡️", callback_data=f"{prefix}:{page + 1}"))
+    return row
+
+def get_page_keyboard(prefix: str, page: int, total_pages: int) -> types.InlineKeyboardMarkup:
+    """Faqat sahifa tugmalaridan iborat klaviatura."""
+    return types.InlineKeyboardMarkup(inline_keyboard=[get_page_nav_row(prefix, page, total_pages)])
+
+def parse_page(data: str) -> int:
+    """callback_data dagi sahifa raqamini oladi ("prefix:3" -> 3); bo'lmasa 0."""
+    parts = data.split(":", 2)
+    return int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+
+def build_paged_keyboard(
+    buttons: List[List[types.InlineKeyboardButton]], result: dict, prefix: str,
+    back_button: types.InlineKeyboardButton
+) -> types.InlineKeyboardMarkup:
+    """Sahifa tugmalari + (bir nechta sahifa bo'lsa) sahifalash qatori + Ortga tugmasi."""
+    rows = list(buttons)
+    if result['pages'] > 1:
+        rows.append(get_page_nav_row(prefix, result['page'], result['pages']))
+    rows.append([back_button])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def edit_list_message(callback: types.CallbackQuery, text: str, reply_markup=None, parse_mode=None) -> None:
+    """Ro'yxat xabarini yangilaydi; "message is not modified" xatosini e'tiborsiz qoldiradi."""
+    try:
+        await callback.message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            await callback.answer("Xatolik yuz berdi!", show_alert=True)
+            logging.error(f"Xatolik: {e}")
+
+def get_export_keyboard() -> types.InlineKeyboardMarkup:
+    """Hisobotlarni fayl ko'rinishida yuklab olish tugmalari (callback_data: "export:<hisobot>:<format>")."""
+    return types.InlineKeyboardMarkup(
+        inline_keyboard=[
+            [types.InlineKeyboardButton(text=f"📥 Pivot {fmt.upper()}", callback_data=f"export:pivot:{fmt}") for fmt in database.EXPORT_FORMATS],
+            [types.InlineKeyboardButton(text=f"🧾 Savdolar (1 yil) {fmt.upper()}", callback_data=f"export:sales:{fmt}") for fmt in database.EXPORT_FORMATS],
+        ]
+    )
+
 def get_mahsulot_keyboard() -> types.InlineKeyboardMarkup:
     """Mahsulotlar bo'limi uchun klaviatura"""
     return types.InlineKeyboardMarkup(
@@ -86,7 +172,8 @@ async def handle_start(message: types.Message):
     keyboard = types.ReplyKeyboardMarkup(
         keyboard=[
             [types.KeyboardButton(text="/mahsulot"), types.KeyboardButton(text="/sotuvchi")],
-            [types.KeyboardButton(text="📊 Oylik (31 kunlik) Savdo Hisoboti")] 
+            [types.KeyboardButton(text="📊 Oylik (31 kunlik) Savdo Hisoboti")],
+            [types.KeyboardButton(text="👥 Agentlar Balansi")]
         ],
         resize_keyboard=True,
         one_time_keyboard=False # Keybordni yashirmaslik
@@ -111,7 +198,8 @@ async def cmd_sotuvchi(message: types.Message, state: FSMContext):
     keyboard = types.ReplyKeyboardMarkup(
         keyboard=[
             [types.KeyboardButton(text="/mahsulot"), types.KeyboardButton(text="/sotuvchi")],
-            [types.KeyboardButton(text="📊 Oylik (31 kunlik) Savdo Hisoboti")] 
+            [types.KeyboardButton(text="📊 Oylik (31 kunlik) Savdo Hisoboti")],
+            [types.KeyboardButton(text="👥 Agentlar Balansi")]
         ],
         resize_keyboard=True,
         one_time_keyboard=False
@@ -132,9 +220,107 @@ async def handle_monthly_sales_report(message: types.Message):
     
     # database.py dagi funksiyani chaqirish 
     report_text = await database.get_daily_sales_pivot_report()
-    
+
+    # Telegram 4096 belgidan uzun xabarni qabul qilmaydi: bunday holda faqat fayl eksporti taklif qilinadi
+    if len(report_text) > 4096:
+        report_text = (
+            "📊 Oylik savdo hisoboti Telegram xabariga sig'maydi "
+            f"({len(report_text):,} belgi). Quyidagi tugmalar orqali fayl ko'rinishida yuklab oling:"
+        )
+
     # Xabarni edit qilamiz
-    await sent_message.edit_text(report_text, parse_mode="Markdown")
+    await sent_message.edit_text(report_text, parse_mode="Markdown", reply_markup=get_export_keyboard())
+
+
+@admin_router.message(Command("export"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_export(message: types.Message):
+    """Hisobotlarni fayl (XLSX / CSV / Parquet) ko'rinishida yuklab olish menyusi."""
+    await message.answer("Qaysi hisobotni yuklab olasiz?", reply_markup=get_export_keyboard())
+
+
+@admin_router.callback_query(F.data.startswith("export:"), F.from_user.id.in_(ADMIN_IDS))
+async def export_report(callback: types.CallbackQuery):
+    """Pivot yoki xom savdolar jadvalini xotirada faylga yozib, Telegram hujjati sifatida yuboradi."""
+    _, report, file_format = callback.data.split(":")
+    if file_format not in database.EXPORT_FORMATS:
+        return await callback.answer("Noma'lum format.", show_alert=True)
+    await callback.answer("Fayl tayyorlanmoqda...", show_alert=False)
+
+    if report == "pivot":
+        df = await database.get_pivot_export_frame()
+    else:
+        df = await database.get_sales_export_frame(date.today() - timedelta(days=365))
+
+    if df is None:
+        return await callback.message.answer("❌ Hisobot ma'lumotlarini yuklashda xato yuz berdi.")
+    if df.is_empty():
+        return await callback.message.answer("⚠️ Eksport uchun ma'lumot topilmadi.")
+
+    try:
+        # Fayl yozish CPU ishi - event loopni to'sib qo'ymaslik uchun alohida oqimda
+        data = await asyncio.to_thread(database.frame_to_bytes, df, file_format)
+    except Exception as e:
+        logging.error(f"Hisobotni {file_format} ga yozishda xato: {e}")
+        return await callback.message.answer(f"❌ Faylni tayyorlashda xato yuz berdi: {e}")
+
+    filename = f"{'pivot_31_kun' if report == 'pivot' else 'savdolar_1_yil'}_{date.today():%Y-%m-%d}.{file_format}"
+    await callback.message.answer_document(
+        types.BufferedInputFile(data, filename=filename),
+        caption=f"📎 {filename} ({df.height:,} qator)"
+    )
+
+
+# --- 4.1 Barcha agentlar balansi (MFY bo'yicha, sahifalangan) ---
+
+async def build_agent_balances_page(page: int) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
+    """Agentlar balansi hisobotining berilgan sahifasini (matn, tugmalar) qaytaradi."""
+    balances = await database.get_all_agent_balances()
+    if balances is None:
+        return "❌ Agentlar balansini yuklashda xato yuz berdi.", None
+    if not balances:
+        return "Hozirda sotuvchilar ro'yxati bo'sh.", None
+
+    blocks: List[Tuple[str, List[str], str]] = []
+    for item in balances:
+        if not blocks or blocks[-1][2] != item['region_mfy']:
+            title = (
+                f"📍 **{item['region_mfy']}** — qarz: {item['region_debt']:,.0f}, "
+                f"haqdorlik: {item['region_credit']:,.0f}, stok: {item['region_stock']:,.1f} {DEFAULT_UNIT}"
+            )
+            blocks.append((title, ["AGENT          |  BALANS (UZS) |  STOK", "-" * 40], item['region_mfy']))
+        # Musbat - agent qarzdor, manfiy - agent haqdor
+        balance = item['debt'] - item['credit']
+        name = item['agent_name'] if len(item['agent_name']) <= 14 else item['agent_name'][:11] + "..."
+        balance_str = f"{balance:,.0f}".rjust(13)
+        stock_str = f"{item['stock_qty']:,.1f}".rjust(5)
+        blocks[-1][1].append(f"{name.ljust(14)} | {balance_str} | {stock_str}")
+
+    pages = build_text_pages([(title, rows) for title, rows, _ in blocks])
+    page = max(0, min(page, len(pages) - 1))
+    header = f"👥 **Agentlar Balansi** (+ qarz, − haqdorlik) — {page + 1}/{len(pages)}\n\n"
+    reply_markup = get_page_keyboard("agent_balances_page", page, len(pages)) if len(pages) > 1 else None
+    return header + pages[page], reply_markup
+
+@admin_router.message(F.text == "👥 Agentlar Balansi", F.from_user.id.in_(ADMIN_IDS))
+async def handle_agent_balances_report(message: types.Message):
+    """Barcha agentlar balansi hisobotining birinchi sahifasini yuboradi."""
+    sent_message = await message.answer("Balanslar hisoblanmoqda, iltimos kuting...")
+    text, reply_markup = await build_agent_balances_page(0)
+    await sent_message.edit_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+
+@admin_router.callback_query(F.data == "report_agent_balances", F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(F.data.startswith("agent_balances_page:"), F.from_user.id.in_(ADMIN_IDS))
+async def report_agent_balances(callback: types.CallbackQuery):
+    """Agentlar balansi hisobotini (kerakli sahifasini) ko'rsatadi."""
+    await callback.answer("Balanslar yuklanmoqda...", show_alert=False)
+    page = int(callback.data.split(":")[1]) if ":" in callback.data else 0
+
+    text, reply_markup = await build_agent_balances_page(page)
+    try:
+        await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logging.error(f"Agentlar balansini ko'rsatishda xato: {e}")
 
 # ==============================================================================
 # V. MAHSULOT BO'LIMI MANTIG'I
@@ -386,105 +572,85 @@ async def list_all_agents_menu(callback: types.CallbackQuery):
             logging.error(f"Xatolik: {e}")
 
 
-# 6.2.1 Barcha Sotuvchilar (Alifbo tartibi)
+# 6.2.1 Barcha Sotuvchilar (Alifbo tartibi, sahifalangan)
 @admin_router.callback_query(F.data == "list_all_agents_alpha", F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(F.data.startswith("agents_alpha:"), F.from_user.id.in_(ADMIN_IDS))
 async def list_all_agents_alpha(callback: types.CallbackQuery):
-    """Barcha agentlarni MFY va Ism bo'yicha tartiblab chiqaradi."""
+    """Agentlarni ism bo'yicha tartiblab, sahifalab chiqaradi (har bir sahifa bazadan alohida olinadi)."""
     await callback.answer("Agentlar ro'yxati yuklanmoqda...", show_alert=False)
-    
-    agents = await database.get_all_agents()
-    
-    if not agents:
-        try:
-            await callback.message.edit_text("Hozirda sotuvchilar ro'yxati bo'sh.", reply_markup=None) 
-        except TelegramBadRequest:
-            await callback.answer("Ro'yxat bo'sh. Qayta urinmang.")
-        return
-    
-    buttons = []
-    # Ortga tugmasi
-    buttons.append([types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu")])
 
-    for agent in agents:
-        buttons.append([types.InlineKeyboardButton(text=f"{agent['agent_name']} ({agent['region_mfy']})", callback_data=f"agent_details:{agent['agent_name']}")])
-        
-    try:
-        await callback.message.edit_text("Agentni tanlang (MFY / Ism bo'yicha tartiblangan):", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons))
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await callback.answer("Agentlar ro'yxati yangilanmadi.")
-        else:
-            await callback.answer("Xatolik yuz berdi!", show_alert=True)
-            logging.error(f"Xatolik: {e}")
+    result = await database.get_agents_page(parse_page(callback.data))
+    if not result or not result['items']:
+        return await edit_list_message(callback, "Hozirda sotuvchilar ro'yxati bo'sh." if result else "❌ Agentlar ro'yxatini yuklashda xato.")
+
+    buttons = [
+        [types.InlineKeyboardButton(text=f"{agent['agent_name']} ({agent['region_mfy']})", callback_data=f"agent_details:{agent['agent_name']}")]
+        for agent in result['items']
+    ]
+    keyboard = build_paged_keyboard(buttons, result, "agents_alpha", types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu"))
+    await edit_list_message(callback, "Agentni tanlang (Ism bo'yicha tartiblangan):", reply_markup=keyboard)
 
 
 # 6.2.2 Sotuvchilar MFY bo'yicha
 @admin_router.callback_query(F.data == "list_agents_by_mfy", F.from_user.id.in_(ADMIN_IDS))
-async def list_agents_by_mfy(callback: types.CallbackQuery):
-    """Barcha mavjud MFYlarni Inline tugmalar sifatida ko'rsatadi."""
-    
-    await callback.answer("MFY ro'yxati yuklanmoqda...", show_alert=False) 
-    
-    agents = await database.get_all_agents()
-    
-    if not agents:
-        try:
-            await callback.message.edit_text("Hozirda sotuvchilar ro'yxati bo'sh.", reply_markup=None)
-        except TelegramBadRequest:
-            await callback.answer("Ro'yxat bo'sh. Qayta urinmang.")
-        return
-        
-    mfy_list = sorted(list(set(a['region_mfy'] for a in agents)))
-    
-    buttons = []
-    # Ortga tugmasi
-    buttons.append([types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu")])
-
-    for mfy in mfy_list:
-        buttons.append([types.InlineKeyboardButton(text=mfy, callback_data=f"mfy_select:{mfy}")])
-        
-    # Xabarni o'zgartirish
-    try:
-        await callback.message.edit_text("MFYni tanlang:", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons))
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await callback.answer("MFY ro'yxati yangilanmadi.")
-        else:
-            await callback.answer("Xatolik yuz berdi!", show_alert=True)
-            logging.error(f"Xatolik: {e}")
+@admin_router.callback_query(F.data.startswith("mfy_list:"), F.from_user.id.in_(ADMIN_IDS))
+async def list_agents_by_mfy(callback: types.CallbackQuery, state: FSMContext):
+    """
+    Agentlar mavjud MFYlarni Inline tugmalar sifatida (sahifalab) ko'rsatadi.
+    MFY nomi (VARCHAR(100)) callback_data ning 64 bayt chegarasiga sig'masligi mumkin, shuning uchun
+    sahifadagi nomlar FSM ma'lumotida saqlanadi, tugmada esa faqat tartib raqami: "mfy_select:<i>".
+    """
+    await callback.answer("MFY ro'yxati yuklanmoqda...", show_alert=False)
+
+    result = await database.get_mfy_page(parse_page(callback.data))
+    if not result or not result['items']:
+        return await edit_list_message(callback, "Hozirda sotuvchilar ro'yxati bo'sh." if result else "❌ MFY ro'yxatini yuklashda xato.")
+
+    mfy_names = [item['region_mfy'] for item in result['items']]
+    await state.update_data(mfy_names=mfy_names)
+    buttons = [
+        [types.InlineKeyboardButton(text=mfy_name, callback_data=f"mfy_select:{i}")]
+        for i, mfy_name in enumerate(mfy_names)
+    ]
+    keyboard = build_paged_keyboard(buttons, result, "mfy_list", types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu"))
+    await edit_list_message(callback, "MFYni tanlang:", reply_markup=keyboard)
 
 
 @admin_router.callback_query(F.data.startswith("mfy_select:"), F.from_user.id.in_(ADMIN_IDS))
-async def list_agents_in_mfy(callback: types.CallbackQuery):
-    """Tanlangan MFYdagi agentlarni Inline tugmalar sifatida chiqaradi."""
-    
-    mfy_name = callback.data.split(":")[1]
+@admin_router.callback_query(F.data.startswith("mfy_agents:"), F.from_user.id.in_(ADMIN_IDS))
+async def list_agents_in_mfy(callback: types.CallbackQuery, state: FSMContext):
+    """
+    Tanlangan MFYdagi agentlarni Inline tugmalar sifatida (sahifalab) chiqaradi.
+    Tanlangan MFY FSM ma'lumotida (selected_mfy) saqlanadi; sahifalash tugmalari faqat "mfy_agents:<sahifa>".
+    """
+    data = await state.get_data()
+    if callback.data.startswith("mfy_select:"):
+        index = callback.data.split(":", 1)[1]
+        mfy_names = data.get('mfy_names', [])
+        mfy_name = mfy_names[int(index)] if index.isdigit() and int(index) < len(mfy_names) else None
+        page = 0
+        if mfy_name is not None:
+            await state.update_data(selected_mfy=mfy_name)
+    else:
+        page, mfy_name = parse_page(callback.data), data.get('selected_mfy')
+    if mfy_name is None:
+        # FSM ma'lumoti tozalangan (masalan, /cancel) - ro'yxatni qaytadan ochish kerak
+        return await callback.answer("Ro'yxat eskirgan. MFYlar ro'yxatini qaytadan oching.", show_alert=True)
     await callback.answer(f"{mfy_name} agentlari yuklanmoqda...", show_alert=False)
-    
-    agents = await database.get_all_agents()
-    
-    mfy_agents = [a for a in agents if a['region_mfy'] == mfy_name]
-    
-    buttons = []
-    for agent in mfy_agents:
-        buttons.append([types.InlineKeyboardButton(text=agent['agent_name'], callback_data=f"agent_details:{agent['agent_name']}")])
-    
-    # Ortga tugmasini qo'shish
-    buttons.append([types.InlineKeyboardButton(text="◀️ Ortga (MFYlar ro'yxati)", callback_data="list_agents_by_mfy")])
-        
-    # Xabarni o'zgartirish
-    try:
-        await callback.message.edit_text(
-            f"**{mfy_name}** MFY agentlari:", 
-            parse_mode="Markdown", 
-            reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons)
-        )
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await callback.answer("Agentlar ro'yxati yangilanmadi.")
-        else:
-            await callback.answer("Xatolik yuz berdi!", show_alert=True)
-            logging.error(f"Xatolik: {e}")
+
+    result = await database.get_agents_page(page, region_mfy=mfy_name)
+    if result is None:
+        return await edit_list_message(callback, "❌ Agentlar ro'yxatini yuklashda xato.")
+
+    buttons = [
+        [types.InlineKeyboardButton(text=agent['agent_name'], callback_data=f"agent_details:{agent['agent_name']}")]
+        for agent in result['items']
+    ]
+    keyboard = build_paged_keyboard(
+        buttons, result, "mfy_agents",
+        types.InlineKeyboardButton(text="◀️ Ortga (MFYlar ro'yxati)", callback_data="list_agents_by_mfy")
+    )
+    await edit_list_message(callback, f"**{mfy_name}** MFY agentlari:", reply_markup=keyboard, parse_mode="Markdown")
 
 # --- 6.3 Agent ma'lumotlari (Stok, Qarz, Parol) ---
 
@@ -530,12 +696,15 @@ async def show_agent_stock(callback: types.CallbackQuery):
 
     agent_name = callback.data.split(":")[1]
     
-    # database.py dan List[Dict] formatida stok ma'lumotlarini olish
-    stock_data = await database.calculate_agent_stock(agent_name)
+    # database.py dan stok ma'lumotlarini olish (get_agent_dashboard - bitta so'rov)
+    dashboard = await database.get_agent_dashboard(agent_name)
+    stock_data = dashboard['stock'] if dashboard else []
     
     reply_markup = get_agent_management_buttons(agent_name)
     
-    if not stock_data:
+    if dashboard is None:
+        text = f"❌ **{agent_name}** stok ma'lumotlarini yuklashda xato yuz berdi."
+    elif not stock_data:
         text = f"**{agent_name}**da hozirda **stok qoldig'i yo'q**."
     else:
         # Ma'lumotlarni formatlash
@@ -590,7 +759,10 @@ async def show_agent_stock(callback: types.CallbackQuery):
 async def show_agent_debt(callback: types.CallbackQuery):
     """Agentning qarzdorlik/haqdorligini chiqaradi."""
     agent_name = callback.data.split(":")[1]
-    debt, credit = await database.calculate_agent_debt(agent_name)
+    dashboard = await database.get_agent_dashboard(agent_name)
+    if dashboard is None:
+        return await callback.answer("Qarzdorlik ma'lumotlarini yuklashda xato!", show_alert=True)
+    debt, credit = dashboard['debt'], dashboard['credit']
     
     if debt > 0:
         text = f"**{agent_name}**ning jami qarzi: **{debt:,.0f} so'm**."
@@ -601,74 +773,54 @@ async def show_agent_debt(callback: types.CallbackQuery):
         
     await callback.answer(text, show_alert=True)
     
-# 6.3.1 Sotuvchilar Parollari Ro'yxati (Monospace)
+# 6.3.1 Sotuvchilar Parollari Ro'yxati (Monospace, sahifalangan)
 
 @admin_router.callback_query(F.data == "list_agent_passwords", F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(F.data.startswith("agent_passwords:"), F.from_user.id.in_(ADMIN_IDS))
 async def list_agent_passwords(callback: types.CallbackQuery):
-    """Agent parollarini Monospace formatda ko'rsatadi."""
+    """Agent parollarini Monospace formatda sahifalab ko'rsatadi."""
     await callback.answer("Parollar yuklanmoqda...", show_alert=False)
-    
-    agents = await database.get_all_agents()
-    if not agents:
-        try:
-            await callback.message.edit_text("Hozirda sotuvchilar ro'yxati bo'sh.", reply_markup=None)
-        except TelegramBadRequest:
-            await callback.answer("Ro'yxat bo'sh. Qayta urinmang.")
-        return
-        
+
+    result = await database.get_agents_page(parse_page(callback.data))
+    if not result or not result['items']:
+        return await edit_list_message(callback, "Hozirda sotuvchilar ro'yxati bo'sh." if result else "❌ Parollarni yuklashda xato.")
+
+    agents = result['items']
     # Monospace format uchun matnni yig'ish
-    max_len = max(len(a['agent_name']) for a in agents) if agents else 15
-    
+    max_len = max(len(a['agent_name']) for a in agents)
+
     text = "🔑 **Agentlar Parollari Ro'yxati:**\n\n"
     text += "```\n"
     text += "AGENT NOMI".ljust(max_len) + " | PAROL\n"
     text += "-" * (max_len + 8) + "\n"
-    
+
     for agent in agents:
         text += f"{agent['agent_name'].ljust(max_len)} | {agent['password']}\n"
     text += "```"
 
-    try:
-        await callback.message.edit_text(text, parse_mode="Markdown")
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await callback.answer("Parollar ro'yxati yangilanmadi.")
-        else:
-            await callback.answer("Xatolik yuz berdi!", show_alert=True)
-            logging.error(f"Xatolik: {e}")
-    
+    keyboard = build_paged_keyboard([], result, "agent_passwords", types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu"))
+    await edit_list_message(callback, text, reply_markup=keyboard, parse_mode="Markdown")
+
 # --- 6.4 Sotuvchilardagi Mahsulotlar Ro'yxati (Agentlar kesimida) ---
 
 @admin_router.callback_query(F.data == "agent_stock_summary", F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(F.data.startswith("stock_summary_page:"), F.from_user.id.in_(ADMIN_IDS))
 async def list_all_agent_stocks(callback: types.CallbackQuery):
-    """Barcha agentlar ro'yxatini chiqarib, ulardagi stokni ko'rish imkonini beradi."""
+    """Agentlar ro'yxatini sahifalab chiqarib, ulardagi stokni ko'rish imkonini beradi."""
     await callback.answer("Agentlar ro'yxati yuklanmoqda...", show_alert=False)
 
-    agents = await database.get_all_agents()
-    if not agents:
-        try:
-            await callback.message.edit_text("Hozirda sotuvchilar ro'yxati bo'sh.", reply_markup=None)
-        except TelegramBadRequest:
-            await callback.answer("Ro'yxat bo'sh. Qayta urinmang.")
-        return
+    result = await database.get_agents_page(parse_page(callback.data))
+    if not result or not result['items']:
+        return await edit_list_message(callback, "Hozirda sotuvchilar ro'yxati bo'sh." if result else "❌ Agentlar ro'yxatini yuklashda xato.")
+
+    buttons = [
+        [types.InlineKeyboardButton(text=f"{agent['agent_name']} ({agent['region_mfy']})", callback_data=f"agent_details:{agent['agent_name']}")]
+        for agent in result['items']
+    ]
+    keyboard = build_paged_keyboard(buttons, result, "stock_summary_page", types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu"))
+    await edit_list_message(callback, "Mahsulot qoldig'ini ko'rish uchun Agentni tanlang:", reply_markup=keyboard)
 
-    buttons = []
-    # Ortga tugmasi
-    buttons.append([types.InlineKeyboardButton(text="◀️ Ortga", callback_data="list_all_agents_menu")])
 
-    for agent in agents:
-        buttons.append([types.InlineKeyboardButton(text=f"{agent['agent_name']} ({agent['region_mfy']})", callback_data=f"agent_details:{agent['agent_name']}")])
-        
-    try:
-        await callback.message.edit_text("Mahsulot qoldig'ini ko'rish uchun Agentni tanlang:", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons))
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            await callback.answer("Agentlar ro'yxati yangilanmadi.")
-        else:
-            await callback.answer("Xatolik yuz berdi!", show_alert=True)
-            logging.error(f"Xatolik: {e}")
-    
-    
 # ==============================================================================
 # 📢 VII. AGENTGA TOVAR BERISH (STOCK KIRITISH) MANTIG'I (FSM) 
 # ==============================================================================
@@ -823,3 +975,136 @@ async def process_stock_entry(message: types.Message, state: FSMContext):
         
     except ValueError:
         await message.answer("Narx noto'g'ri kiritildi. Iltimos, musbat raqamda kiriting.")
+
+
+# ==============================================================================
+# VIII. TEXNIK TEKSHIRUVLAR (Ma'lumotlar bazasi)
+# ==============================================================================
+
+@admin_router.message(Command("plan_check"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_plan_check(message: types.Message):
+    """
+    Hisobot so'rovlarining EXPLAIN rejasini tekshiradi.
+    /plan_check 100000 - jadvallarning vaqtinchalik nusxalarida 100 000 qatorli sintetik ma'lumot bilan tekshiradi
+    (haqiqiy jadvallar va ularning statistikasiga tegilmaydi).
+    """
+    parts = message.text.split()
+    seed_rows = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+
+    sent_message = await message.answer("So'rov rejalari tekshirilmoqda, iltimos kuting...")
+    results = await database.check_report_query_plans(seed_rows)
+
+    if results is None:
+        return await sent_message.edit_text("❌ So'rov rejalarini tekshirishda xato yuz berdi.")
+
+    lines = [f"🔍 **So'rov rejalari** (sintetik qatorlar: {seed_rows:,})\n"]
+    for query_name, seq_scans in results.items():
+        if seq_scans:
+            lines.append(f"❌ {query_name}: Seq Scan ({', '.join(seq_scans)})")
+        else:
+            lines.append(f"✅ {query_name}: indeks ishlatilmoqda")
+
+    await sent_message.edit_text("\n".join(lines), parse_mode="Markdown")
+
+
+@admin_router.message(Command("stock_verify"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_stock_verify(message: types.Message):
+    """agent_stock_balance jadvalini to'liq tarix bilan solishtiradi va farqlarni chiqaradi."""
+    sent_message = await message.answer("Stok qoldiqlari tekshirilmoqda, iltimos kuting...")
+    drift = await database.verify_agent_stock_balance()
+
+    if drift is None:
+        return await sent_message.edit_text("❌ Stok qoldiqlarini tekshirishda xato yuz berdi (natija noma'lum).")
+    if not drift:
+        return await sent_message.edit_text("✅ Stok qoldiqlari jadvali tarix bilan mos keladi.")
+
+    lines = [f"⚠️ **{len(drift)} ta farq topildi** (/stock_rebuild bilan tuzatish mumkin):\n", "```"]
+    for row in drift[:30]:
+        lines.append(
+            f"{row['agent_name']} / {row['product_name']}: "
+            f"berilgan {row['stored_received']:,.1f}≠{row['expected_received']:,.1f}, "
+            f"sotilgan {row['stored_sold']:,.1f}≠{row['expected_sold']:,.1f}"
+        )
+    lines.append("```")
+    await sent_message.edit_text("\n".join(lines), parse_mode="Markdown")
+
+
+@admin_router.message(Command("stock_rebuild"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_stock_rebuild(message: types.Message):
+    """agent_stock_balance jadvalini stock va sales tarixidan qayta quradi."""
+    sent_message = await message.answer("Stok qoldiqlari qayta qurilmoqda, iltimos kuting...")
+    count = await database.rebuild_agent_stock_balance()
+
+    if count is None:
+        return await sent_message.edit_text("❌ Stok qoldiqlarini qayta qurishda xato yuz berdi.")
+    await sent_message.edit_text(f"✅ Stok qoldiqlari qayta qurildi: {count} ta agent/mahsulot qatori.")
+
+
+@admin_router.message(Command("balance_audit"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_balance_audit(message: types.Message):
+    """Har bir agentning doimiy qarz balansini to'liq qayta hisoblash bilan solishtiradi."""
+    sent_message = await message.answer("Qarzdorlik balanslari tekshirilmoqda, iltimos kuting...")
+    drift = await database.audit_agent_balance()
+
+    if drift is None:
+        return await sent_message.edit_text("❌ Qarzdorlik auditida xato yuz berdi (natija noma'lum).")
+    if not drift:
+        return await sent_message.edit_text("✅ Barcha agentlarning qarzdorlik balansi tarix bilan mos keladi.")
+
+    lines = [f"⚠️ **{len(drift)} ta agentda farq topildi** (/balance_rebuild bilan tuzatish mumkin):\n", "```"]
+    for row in drift[:30]:
+        lines.append(f"{row['agent_name']}: {row['stored_balance']:,.0f} ≠ {row['expected_balance']:,.0f}")
+    lines.append("```")
+    await sent_message.edit_text("\n".join(lines), parse_mode="Markdown")
+
+
+@admin_router.message(Command("balance_rebuild"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_balance_rebuild(message: types.Message):
+    """agent_balance jadvalini stock va debt tarixidan qayta quradi."""
+    sent_message = await message.answer("Qarzdorlik balanslari qayta qurilmoqda, iltimos kuting...")
+    count = await database.rebuild_agent_balance()
+
+    if count is None:
+        return await sent_message.edit_text("❌ Qarzdorlik balanslarini qayta qurishda xato yuz berdi.")
+    await sent_message.edit_text(f"✅ Qarzdorlik balanslari qayta qurildi: {count} ta agent.")
+
+
+@admin_router.message(Command("rollup_rebuild"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_rollup_rebuild(message: types.Message):
+    """daily_sales_rollup jadvalini butun savdo tarixidan qayta quradi (pivot hisobot uchun backfill)."""
+    sent_message = await message.answer("Kunlik savdo yig'indisi qayta qurilmoqda, iltimos kuting...")
+    count = await database.rebuild_daily_sales_rollup()
+
+    if count is None:
+        return await sent_message.edit_text("❌ Kunlik savdo yig'indisini qayta qurishda xato yuz berdi.")
+    await sent_message.edit_text(f"✅ Kunlik savdo yig'indisi qayta qurildi: {count} ta kun/agent qatori.")
+
+
+@admin_router.message(Command("db_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_db_stats(message: types.Message):
+    """DB havzasi holati, ulanish kutish va so'rovlar kechikishini ko'rsatadi."""
+    metrics = database.get_runtime_metrics()
+    db = metrics["db"]
+    pool = db["pool"]
+
+    lines = ["📈 **DB havzasi**", "```"]
+    if pool:
+        lines.append(f"Hajm: {pool['size']} (min {pool['min_size']}, max {pool['max_size']})")
+        lines.append(f"Faol: {pool['active']} | Bo'sh: {pool['idle']}")
+    else:
+        lines.append("Havza hali yaratilmagan")
+    acquire = db["acquire"]
+    lines.append(f"Ulanish olish: {acquire['count']} marta, o'rtacha {acquire['avg_ms']} ms, max {acquire['max_ms']} ms")
+    lines.append("")
+    lines.append("FUNKSIYA".ljust(30) + " | SONI   | O'RT ms | MAX ms")
+    for name, q in sorted(db["queries"].items(), key=lambda item: -item[1]["count"]):
+        lines.append(f"{name[:30].ljust(30)} | {str(q['count']).rjust(6)} | {str(q['avg_ms']).rjust(7)} | {q['max_ms']}")
+    lines.append("```")
+
+    cache = metrics["agent_cache"]
+    sheets = metrics["sheets_client"]
+    lines.append(f"Agent keshi: {cache['hits']} hit / {cache['misses']} miss ({cache['size']} ta yozuv)")
+    report = metrics["report_cache"]
+    lines.append(f"Hisobot keshi: {report['hits']} hit / {report['misses']} miss, {report['shared']} ta umumiy hisoblash")
+    lines.append(f"Sheets ulanishi: {sheets['authorizations']} avtorizatsiya / {sheets['reuses']} qayta foydalanish")
+    await message.answer("\n".join(lines), parse_mode="Markdown")
@@ -0,0 +1,41 @@
+# ==============================================================================
+# bench/pivot_render.py
+# Pivot hisobot formatlash benchmarki: render_daily_sales_pivot sintetik kunlik qatorlarda (DB kerak emas)
+# Bot ichida emas, alohida ishga tushiriladi (loyiha ildizidan):
+#     python -m bench.pivot_render 500
+# ==============================================================================
+
+import sys
+import time
+from datetime import date, timedelta
+
+import polars as pl
+
+from database import render_daily_sales_pivot
+
+def build_frame(agents: int, days: int = 31) -> pl.DataFrame:
+    """agents x days ta sintetik kunlik savdo qatori (agent_name, region_mfy, qty_kg, sale_date)."""
+    today = date.today()
+    size = agents * days
+    return pl.DataFrame({
+        'agent_name': [f"agent_{i % agents}" for i in range(size)],
+        'region_mfy': [f"MFY {i % agents % 20}" for i in range(size)],
+        'qty_kg': [float(i % 50) + 0.5 for i in range(size)],
+        'sale_date': [today - timedelta(days=i // agents) for i in range(size)],
+    })
+
+def run(agents: int, days: int = 31) -> dict:
+    """render_daily_sales_pivot vaqtini (ms) o'lchaydi."""
+    df = build_frame(agents, days)
+    started = time.perf_counter()
+    report = render_daily_sales_pivot(df)
+    return {"rows": df.height, "render_ms": (time.perf_counter() - started) * 1000, "chars": len(report)}
+
+def main() -> None:
+    agents = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 500
+    result = run(max(agents, 1))
+    print(f"Pivot formatlash ({agents} agent x 31 kun, {result['rows']:,} qator)")
+    print(f"{result['render_ms']:,.1f} ms, {result['chars']:,} belgi")
+
+if __name__ == '__main__':
+    main()
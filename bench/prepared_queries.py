@@ -0,0 +1,110 @@
+# ==============================================================================
+# bench/prepared_queries.py
+# Oddiy SQL matni va tayyorlangan so'rovlar (PREPARED_QUERIES) kechikishini solishtiradi
+# Bot ichida emas, alohida ishga tushiriladi (loyiha ildizidan):
+#     python -m bench.prepared_queries 500
+# BENCH_DATABASE_URL berilsa shu (sinov) bazaga, aks holda DATABASE_DIRECT_URL ga ulanadi.
+# Barcha so'rovlar jadvallarning vaqtinchalik (pg_temp) nusxalarida bajariladi: haqiqiy jadvallar va
+# ularning ketma-ketliklari (sales_sale_id_seq, outbox_outbox_id_seq) ishlatilmaydi.
+# ==============================================================================
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import asyncpg
+
+from config import DATABASE_DIRECT_URL, DB_STATEMENT_CACHE_SIZE
+from database import BotConnection, PREPARED_QUERIES
+
+# Nusxasi yaratiladigan jadvallar va ulardagi SERIAL ustunlar (nusxada o'z IDENTITY si bilan almashtiriladi)
+SCRATCH_TABLES = {
+    "agents": None,
+    "products": None,
+    "sales": "sale_id",
+    "stock": "entry_id",
+    "debt": "debt_id",
+    "agent_stock_balance": None,
+    "agent_balance": None,
+    "daily_sales_rollup": None,
+    "outbox": "outbox_id",
+    "fsm_storage": None,
+}
+
+# Bitta chaqiruv qaysi nomli so'rovlardan iborat (funksiya nomi -> [(so'rov nomi, parametrlar)])
+def benchmark_cases(now: datetime) -> Dict[str, List[tuple]]:
+    agent, product = "__bench_agent", "__bench_product"
+    return {
+        "get_agent_by_telegram_id": [("agent_by_telegram_id", (-1,))],
+        "calculate_agent_stock": [("agent_stock", (agent,))],
+        "add_sales_transaction": [
+            ("insert_sale", (agent, product, 1.0, 1000.0, 1000.0, now.date(), now.time())),
+            ("add_sold_qty", (agent, product, 1.0)),
+            ("add_daily_sales", (now.date(), agent, 1.0, 1000.0)),
+            ("insert_outbox", ("__bench", "[]")),
+        ],
+        "fetch_fsm_record": [("fsm_record", ("__bench",))],
+        "upsert_fsm_records": [("upsert_fsm", ("__bench", None, "{}"))],
+    }
+
+async def create_scratch_tables(conn) -> None:
+    """Jadvallarning indeksli vaqtinchalik nusxalarini yaratadi (pg_temp search_path da birinchi turadi)."""
+    for table, serial_column in SCRATCH_TABLES.items():
+        await conn.execute(
+            f"CREATE TEMP TABLE {table} (LIKE {table} INCLUDING DEFAULTS INCLUDING INDEXES) ON COMMIT DROP;"
+        )
+        if serial_column:
+            # LIKE haqiqiy ketma-ketlikdagi nextval() ni ham ko'chiradi - uning o'rniga nusxaning o'z hisoblagichi
+            await conn.execute(f"ALTER TABLE pg_temp.{table} ALTER COLUMN {serial_column} DROP DEFAULT;")
+            await conn.execute(
+                f"ALTER TABLE pg_temp.{table} ALTER COLUMN {serial_column} ADD GENERATED BY DEFAULT AS IDENTITY;"
+            )
+
+async def run(iterations: int) -> Dict[str, Dict[str, float]]:
+    """Har bir funksiya so'rovlarini oddiy SQL va tayyorlangan so'rov orqali iterations marta bajaradi (ms/chaqiruv)."""
+    conn = await asyncpg.connect(
+        os.getenv("BENCH_DATABASE_URL") or DATABASE_DIRECT_URL,
+        connection_class=BotConnection,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    )
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        # So'rovlar nusxalar yaratilgandan keyin tayyorlanadi, shuning uchun ular ham nusxalarga murojaat qiladi
+        await create_scratch_tables(conn)
+        await conn.execute("""
+            INSERT INTO agents (agent_name, region_mfy, password, telegram_id) VALUES ('__bench_agent', '__bench', '__bench', -1);
+            INSERT INTO products (name, price) VALUES ('__bench_product', 1000);
+        """)
+
+        results = {}
+        for func_name, steps in benchmark_cases(datetime.now()).items():
+            timings = {}
+            for mode in ("raw", "prepared"):
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    for query_name, params in steps:
+                        if mode == "raw":
+                            await conn.fetch(PREPARED_QUERIES[query_name], *params)
+                        else:
+                            await conn.fetch_prepared(query_name, *params)
+                timings[f"{mode}_ms"] = round((time.perf_counter() - started) * 1000 / iterations, 3)
+            results[func_name] = timings
+        return results
+    finally:
+        await tr.rollback()
+        await conn.close()
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 200
+    results = asyncio.run(run(max(iterations, 1)))
+    print(f"Tayyorlangan so'rovlar ({iterations} marta, 1 chaqiruv uchun ms)")
+    print("FUNKSIYA".ljust(26) + " | ODDIY  | TAYYOR")
+    for func_name, t in results.items():
+        print(f"{func_name.ljust(26)} | {str(t['raw_ms']).rjust(6)} | {t['prepared_ms']}")
+
+if __name__ == '__main__':
+    main()
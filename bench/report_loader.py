@@ -0,0 +1,72 @@
+# ==============================================================================
+# bench/report_loader.py
+# Hisobot ma'lumotlarini yuklash benchmarki: Record -> dict -> DataFrame va COPY CSV -> Polars
+# Bot ichida emas, alohida ishga tushiriladi (loyiha ildizidan):
+#     python -m bench.report_loader 1000000
+# BENCH_DATABASE_URL berilsa shu (sinov) bazaga, aks holda DATABASE_DIRECT_URL ga ulanadi.
+# ==============================================================================
+
+import asyncio
+import os
+import sys
+import time
+
+import asyncpg
+import polars as pl
+
+from config import DATABASE_DIRECT_URL
+from database import PIVOT_SALES_DTYPES, fetch_frame
+
+# Sintetik savdo qatorlari (vaqtinchalik jadval, tranzaksiya bilan birga yo'qoladi)
+SEED_SQL = """
+    CREATE TEMP TABLE __loader_bench ON COMMIT DROP AS
+    SELECT
+        'agent_' || (g % 500) AS agent_name,
+        'MFY ' || (g % 20) AS region_mfy,
+        ((g % 50) + 0.5)::NUMERIC(14, 2) AS qty_kg,
+        CURRENT_DATE - (g % 31) AS sale_date
+    FROM generate_series(1, {rows}) g;
+"""
+
+LOAD_SQL = "SELECT agent_name, region_mfy, qty_kg, sale_date FROM __loader_bench;"
+
+async def run(rows: int) -> dict:
+    """rows ta sintetik qatorni ikki usulda yuklash vaqtini (ms) o'lchaydi. Alohida ulanish, vaqt cheklovisiz."""
+    conn = await asyncpg.connect(os.getenv("BENCH_DATABASE_URL") or DATABASE_DIRECT_URL)
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        await conn.execute(SEED_SQL.format(rows=int(rows)))
+
+        started = time.perf_counter()
+        records = await conn.fetch(LOAD_SQL)
+        df_rows = pl.DataFrame([dict(r) for r in records]).with_columns(
+            pl.col('qty_kg').cast(pl.Float64, strict=False)
+        )
+        dict_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        df_copy = await fetch_frame(conn, LOAD_SQL, dtypes=PIVOT_SALES_DTYPES)
+        copy_ms = (time.perf_counter() - started) * 1000
+
+        return {
+            "rows": df_copy.height,
+            "dict_ms": dict_ms,
+            "copy_ms": copy_ms,
+            "same_total": round(df_rows['qty_kg'].sum(), 2) == round(df_copy['qty_kg'].sum(), 2),
+        }
+    finally:
+        await tr.rollback()
+        await conn.close()
+
+def main() -> None:
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 100_000
+    result = asyncio.run(run(max(rows, 1)))
+    print(f"Hisobot ma'lumotlarini yuklash ({result['rows']:,} qator)")
+    print(f"dict -> DataFrame : {result['dict_ms']:,.1f} ms")
+    print(f"COPY -> Polars    : {result['copy_ms']:,.1f} ms")
+    same = "ha" if result['same_total'] else "yo'q"
+    print(f"Natijalar mos     : {same}")
+
+if __name__ == '__main__':
+    main()
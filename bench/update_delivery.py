@@ -0,0 +1,112 @@
+# ==============================================================================
+# bench/update_delivery.py
+# Update qayta ishlash tezligi: faqat Dispatcher (dp.feed_update) va webhook (aiohttp HTTP + Dispatcher)
+# Bot ichida emas, alohida ishga tushiriladi (loyiha ildizidan):
+#     python -m bench.update_delivery 5000
+# Telegram API va DB chaqirilmaydi. "dispatcher" raqami haqiqiy polling emas: getUpdates so'rovlari
+# (tarmoq kechikishi) o'lchanmaydi, faqat Dispatcher ning o'z narxi. Ikki raqam farqi - webhook HTTP qatlami narxi.
+# ==============================================================================
+
+import asyncio
+import sys
+import time
+from typing import Dict
+
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from config import UPDATE_CONCURRENCY, WEBHOOK_SECRET
+from middlewares import ConcurrencyLimitMiddleware
+
+def build_dispatcher() -> Dispatcher:
+    """bot_main dagi kabi izolyatsiya va middleware'li, lekin bo'sh handlerli Dispatcher."""
+    router = Router()
+
+    @router.message()
+    async def bench_noop(message: types.Message):
+        return None
+
+    dp = Dispatcher(events_isolation=SimpleEventIsolation())
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(UPDATE_CONCURRENCY))
+    dp.include_router(router)
+    return dp
+
+def build_payloads(updates: int) -> list:
+    """100 xil foydalanuvchi: bir foydalanuvchi update'lari ketma-ket, turli foydalanuvchilarniki parallel."""
+    return [
+        {
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": 0,
+                "chat": {"id": 1000 + i % 100, "type": "private"},
+                "from": {"id": 1000 + i % 100, "is_bot": False, "first_name": "Bench"},
+                "text": "bench",
+            },
+        }
+        for i in range(updates)
+    ]
+
+async def run(updates: int, workers: int = 40) -> Dict[str, float]:
+    """
+    Bir xil sintetik Update'larni workers ta parallel yuboruvchi bilan ikki yo'ldan o'tkazib, update/soniya ni qaytaradi.
+    workers - Telegram webhook max_connections ning sukut qiymati (40).
+    """
+    bot = Bot(token="42:BENCHMARK")
+    dp = build_dispatcher()
+    payloads = build_payloads(updates)
+
+    async def run_workers(deliver) -> float:
+        queue = iter(payloads)
+
+        async def worker():
+            for payload in queue:
+                await deliver(payload)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(max(workers, 1))))
+        return updates / (time.perf_counter() - started)
+
+    async def deliver_dispatcher(payload: dict):
+        await dp.feed_update(bot, types.Update.model_validate(payload, context={"bot": bot}))
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=False
+    ).register(app, path="/bench")
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+
+    try:
+        dispatcher_rate = await run_workers(deliver_dispatcher)
+        async with TestClient(TestServer(app)) as client:
+            async def deliver_webhook(payload: dict):
+                response = await client.post("/bench", json=payload, headers=headers)
+                response.raise_for_status()
+                await response.read()
+
+            webhook_rate = await run_workers(deliver_webhook)
+    finally:
+        await bot.session.close()
+
+    return {
+        "updates": updates,
+        "workers": workers,
+        "dispatcher_per_sec": dispatcher_rate,
+        "webhook_per_sec": webhook_rate,
+    }
+
+def main() -> None:
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1000
+    result = asyncio.run(run(max(updates, 1)))
+    print(f"Update qayta ishlash ({result['updates']:,} update, {result['workers']} parallel)")
+    print(f"faqat Dispatcher (feed_update, getUpdates'siz) : {result['dispatcher_per_sec']:,.1f} update/s")
+    print(f"webhook (aiohttp HTTP + Dispatcher)            : {result['webhook_per_sec']:,.1f} update/s")
+
+if __name__ == '__main__':
+    main()
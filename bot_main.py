@@ -1,21 +1,28 @@
 # ==============================================================================
-# server.py (Long Polling)
-# Bu fayl botni uzoq so'rov (Long Polling) rejimida ishga tushirish uchun mo'ljallangan
+# server.py (Long Polling / Webhook)
+# Bu fayl botni BOT_MODE ga ko'ra uzoq so'rov (Long Polling) yoki
+# aiohttp Webhook server rejimida ishga tushirish uchun mo'ljallangan
 # ==============================================================================
 
 # I. KERAKLI KUTUBXONALARNI IMPORT QILISH
-# aiohttp dan foydalanilmaydi
 import asyncio
 import logging
+from typing import Optional
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
-# Update (webhook uchun) o'rniga faqat kerakli scope'lar import qilinadi
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import BotCommandScopeAllPrivateChats, BotCommandScopeChat
 
 # Loyiha fayllaridan importlar
-# Webhook/Server sozlamalari endi kerak emas, faqat bot token va admin ID'lar
-from config import BOT_TOKEN, ADMIN_IDS
+from config import (
+    BOT_TOKEN, ADMIN_IDS, BOT_MODE, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET,
+    WEB_SERVER_HOST, WEB_SERVER_PORT, CONCURRENT_UPDATES, UPDATE_CONCURRENCY,
+    METRICS_PATH, METRICS_HOST, METRICS_PORT
+)
 import database
+from storage import PostgresStorage, build_events_isolation, build_fsm_storage
+from middlewares import ConcurrencyLimitMiddleware, FSMWriteBatchMiddleware
 from admin_handlers import admin_router
 from seller_handlers import seller_router
 
@@ -30,7 +37,19 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 default_properties = DefaultBotProperties(parse_mode="HTML") 
 bot = Bot(token=BOT_TOKEN, default=default_properties)
 
-dp = Dispatcher()
+# FSM holatlari FSM_STORAGE sozlamasiga ko'ra saqlanadi (memory / redis / postgres / sqlite).
+# events_isolation bir foydalanuvchining update'larini FSM holati o'qilishidan OLDIN qulflaydi, shuning uchun
+# navbatdagi update oldingisi yozgan holat bilan yo'naltiriladi (Redis/Postgres da barcha workerlar bo'ylab).
+fsm_storage = build_fsm_storage()
+dp = Dispatcher(storage=fsm_storage, events_isolation=build_events_isolation(fsm_storage))
+
+# Parallel rejimda: bir vaqtda bajariladigan handlerlar soniga umumiy limit
+if CONCURRENT_UPDATES:
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(UPDATE_CONCURRENCY))
+
+# Postgres FSM: bitta update ning barcha holat/ma'lumot yozuvlari update oxirida bitta upsert bilan yoziladi
+if isinstance(fsm_storage, PostgresStorage):
+    dp.update.outer_middleware(FSMWriteBatchMiddleware(fsm_storage))
 
 # Routerlarni ulash
 dp.include_router(admin_router)
@@ -70,53 +89,166 @@ async def setup_commands(bot: Bot):
 
 
 # ==============================================================================
-# IV. ASOSIY LONG POLLING FUNKSIYASI
+# IV. UMUMIY ISHGA TUSHIRISH VA TO'XTATISH
 # ==============================================================================
 
-async def main():
-    """Botni Long Polling rejimida ishga tushiradi va barcha zaruriy amallarni bajaradi."""
-    logging.info("🚀 Bot ishga tushirilmoqda (Long Polling)...")
+# Outbox -> Sheets sinkronlash fon vazifasi
+outbox_task: Optional[asyncio.Task] = None
+# Agent keshini boshqa jarayonlardagi o'zgarishlarda tozalovchi fon vazifasi
+agent_listener_task: Optional[asyncio.Task] = None
+# Metrikalar serveri (METRICS_PORT berilgan bo'lsa)
+metrics_runner: Optional[web.AppRunner] = None
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """DB havzasi, keshlar va Sheets metrikalarini JSON ko'rinishida qaytaradi."""
+    return web.json_response(database.get_runtime_metrics())
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    """METRICS_PORT berilgan bo'lsa, faqat metrikalar uchun alohida kichik server ochadi (ikkala rejimda)."""
+    if METRICS_PORT is None: return None
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"📈 Metrikalar: http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+    return runner
+
+async def prepare(mode_name: str) -> bool:
+    """DB, buyruqlar va fon vazifalarini tayyorlaydi (ikkala rejim uchun umumiy)."""
+    global outbox_task, agent_listener_task, metrics_runner
 
     # 1. DB jadvallarini yaratish/tekshirish
     db_ready = await database.create_tables()
     if not db_ready:
         logging.critical("❌ Ma'lumotlar bazasi tayyor emas. Ishlash to'xtatiladi.")
-        return 
+        return False
 
-    # 2. Oldingi Webhookni o'chirib qo'yish (agar mavjud bo'lsa)
-    # drop_pending_updates=True botni ishga tushirishdan oldin turib qolgan xabarlarni o'chiradi
-    await bot.delete_webhook(drop_pending_updates=True)
-    logging.info("🔗 Webhook o'chirildi va kutilayotgan yangilanishlar tashlab yuborildi.")
-
-    # 3. Buyruqlar ro'yxatini Telegramga o'rnatish
+    # 2. Buyruqlar ro'yxatini Telegramga o'rnatish
     await setup_commands(bot)
-    
-    # 4. Administratorga xabar berish
+
+    # 3. Administratorga xabar berish
     if ADMIN_IDS:
         try:
-            await bot.send_message(ADMIN_IDS[0], "✅ Bot Long Polling rejimida ishga tushdi.")
+            await bot.send_message(ADMIN_IDS[0], f"✅ Bot {mode_name} rejimida ishga tushdi.")
         except Exception as e:
             logging.warning(f"Adminlarga xabar yuborishda xato yuz berdi: {e}")
 
-    # 5. Long Pollingni boshlash
+    # 4. Outbox -> Sheets sinkronlash fon vazifasini ishga tushirish
+    outbox_task = asyncio.create_task(database.run_outbox_drain())
+
+    # 5. Agent keshi uchun agent_changed tinglovchisini ishga tushirish
+    agent_listener_task = asyncio.create_task(database.run_agent_cache_listener())
+
+    # 6. Metrikalar serveri (ommaviy webhook serveridan alohida port)
+    metrics_runner = await start_metrics_server()
+    return True
+
+async def cleanup():
+    """Fon vazifalarini to'xtatadi va barcha ulanishlarni yopadi."""
+    # 1. Fon vazifalarini to'xtatish (yozilmagan qatorlar outboxda qoladi)
+    for task in (outbox_task, agent_listener_task):
+        if task is None: continue
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    # 2. Metrikalar serverini to'xtatish
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+    # 3. FSM saqlash backendini yopish
+    await dp.storage.close()
+
+    # 4. DB havzasini yopish
+    if database.DB_POOL:
+        await database.DB_POOL.close()
+        logging.info("PostgreSQL ulanish havzasi yopildi.")
+
+    # 5. Bot sessiyasini yopish
+    await bot.session.close()
+    logging.warning("🛑 Bot to'xtatildi.")
+
+
+# ==============================================================================
+# V. ASOSIY LONG POLLING FUNKSIYASI
+# ==============================================================================
+
+async def main():
+    """Botni Long Polling rejimida ishga tushiradi va barcha zaruriy amallarni bajaradi."""
+    logging.info("🚀 Bot ishga tushirilmoqda (Long Polling)...")
+
+    if not await prepare("Long Polling"):
+        return
+
+    # Oldingi Webhookni o'chirib qo'yish (agar mavjud bo'lsa)
+    # drop_pending_updates=True botni ishga tushirishdan oldin turib qolgan xabarlarni o'chiradi
+    await bot.delete_webhook(drop_pending_updates=True)
+    logging.info("🔗 Webhook o'chirildi va kutilayotgan yangilanishlar tashlab yuborildi.")
+
+    # Long Pollingni boshlash
     try:
-        await dp.start_polling(bot)
+        # handle_as_tasks: har bir update alohida vazifada (tartibni events_isolation saqlaydi)
+        await dp.start_polling(bot, handle_as_tasks=CONCURRENT_UPDATES)
     finally:
-        # 6. Bot to'xtaganda (ctrl+c yoki xatolik) DB havzasini yopish
-        if database.DB_POOL:
-            await database.DB_POOL.close()
-            logging.info("PostgreSQL ulanish havzasi yopildi.")
-        
-        # 7. Bot sessiyasini yopish
-        await bot.session.close()
-        logging.warning("🛑 Bot to'xtatildi.")
+        # Bot to'xtaganda (ctrl+c yoki xatolik) hammasini yopish
+        await cleanup()
+
+
+# ==============================================================================
+# VI. WEBHOOK (aiohttp) SERVER REJIMI
+# ==============================================================================
+
+async def on_webhook_startup(bot: Bot):
+    """aiohttp server ishga tushganda: tayyorlash va webhookni Telegramda o'rnatish."""
+    logging.info("🚀 Bot ishga tushirilmoqda (Webhook)...")
+    if not await prepare("Webhook"):
+        raise RuntimeError("Ma'lumotlar bazasi tayyor emas.")
+
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logging.info("🔗 Webhook o'rnatildi.")
+
+async def on_webhook_shutdown(bot: Bot):
+    """aiohttp server to'xtaganda (SIGTERM/SIGINT). Webhook o'chirilmaydi: deploy vaqtida
+    Telegram yangilanishlarni navbatda ushlab turadi va yangi nusxa ularni qabul qiladi."""
+    await cleanup()
+
+def build_webhook_app() -> web.Application:
+    """
+    Webhook rejimi uchun aiohttp ilovasini yaratadi.
+    Update shu HTTP so'rov ichida qayta ishlanadi (handle_in_background=False), shuning uchun
+    Telegram javobni faqat handler tugagach oladi; maxfiy kalit mos kelmasa 401 qaytariladi.
+    Lokal test: WEBHOOK_PATH ga Update JSON ni POST qilish (X-Telegram-Bot-Api-Secret-Token sarlavhasi bilan).
+    """
+    dp.startup.register(on_webhook_startup)
+    dp.shutdown.register(on_webhook_shutdown)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=False
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
 
 
 if __name__ == '__main__':
     # Lokal test qilish uchun muhit
     try:
-        # Asosiy asinxron funksiyani ishga tushirish
-        asyncio.run(main())
+        if BOT_MODE == "webhook":
+            # run_app SIGINT/SIGTERM ni ushlaydi va shutdown hooklarini chaqiradi
+            web.run_app(build_webhook_app(), host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+        else:
+            # Asosiy asinxron funksiyani ishga tushirish
+            asyncio.run(main())
     except KeyboardInterrupt:
         logging.warning("Dastur foydalanuvchi tomonidan to'xtatildi (KeyboardInterrupt).")
     except Exception as e:
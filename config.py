@@ -13,6 +13,21 @@ ADMIN_IDS = [int(i.strip()) for i in os.getenv("ADMIN_IDS", "").split(',') if i.
 
 # --- NeonTech (PostgreSQL) Sozlamalari ---
 DATABASE_URL = os.getenv("DATABASE_URL")
+# LISTEN/NOTIFY pgbouncer (transaction rejimi) orqali ishlamaydi: Neon -pooler manzili ishlatilsa,
+# bu yerga to'g'ridan-to'g'ri (pooler'siz) ulanish manzili beriladi
+DATABASE_DIRECT_URL = os.getenv("DATABASE_DIRECT_URL") or DATABASE_URL
+# Ulanishlar havzasi (asyncpg Pool) - Neon ulanish limitiga qarab sozlanadi
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 5))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+# Shuncha soniya ishlatilmagan ulanish yopiladi (0 - hech qachon)
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", 300))
+# asyncpg tayyorlangan so'rovlar keshi (pgbouncer transaction rejimida 0 qilinadi)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+# Bitta so'rov uchun maksimal vaqt (soniya)
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+# Qayta qurish / backfill / audit / indeks yaratish so'rovlari uchun maksimal vaqt (soniya).
+# asyncpg da timeout=None DB_COMMAND_TIMEOUT ni bildiradi, shuning uchun alohida katta qiymat beriladi.
+DB_MAINTENANCE_TIMEOUT = float(os.getenv("DB_MAINTENANCE_TIMEOUT", 3600))
 
 # --- Google Sheets Sozlamalari (SERVICE_ACCOUNT_JSON orqali xavfsiz ulanish) ---
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
@@ -28,14 +43,71 @@ SHEET_NAMES = {
     # SAVDO (SALES) varag'i dinamik bo'lgani uchun bu yerda yo'q
 }
 
+# --- Sheets Varaqlari Sozlamalari ---
+# Oy tugashiga shuncha kun qolganda keyingi oyning savdo varag'i oldindan yaratiladi
+SHEETS_PRECREATE_DAYS = int(os.getenv("SHEETS_PRECREATE_DAYS", 2))
+
+# --- Outbox (Sheets sinkronlash navbati) Sozlamalari ---
+# Bir aylanishda bazadan olinadigan outbox yozuvlari soni
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 200))
+# Yangi yozuv bo'lmasa, outbox necha soniyada qayta tekshiriladi
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+# Yangi yozuv fon vazifasini uyg'otgach, OUTBOX_BATCH_SIZE qator yig'ilmasa shuncha soniya ko'proq qator
+# kutiladi va ular har bir varaqqa bitta append_rows bilan yoziladi (Sheets API kvotasi uchun)
+OUTBOX_FLUSH_WINDOW = float(os.getenv("OUTBOX_FLUSH_WINDOW", 5))
+# Qayta urinishlar orasidagi kutish: 2^urinish * BASE, lekin MAX dan oshmaydi (soniya)
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 5))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 900))
+# Olingan yozuv shu muddat ichida boshqa worker tomonidan qayta olinmaydi (soniya)
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", 300))
+
+# --- Xotiradagi Kesh Sozlamalari ---
+# Telegram ID -> Agent keshining yashash muddati (soniya) va maksimal hajmi
+AGENT_CACHE_TTL = float(os.getenv("AGENT_CACHE_TTL", 300))
+AGENT_CACHE_SIZE = int(os.getenv("AGENT_CACHE_SIZE", 5000))
+# "Agent emas" natijasi shuncha soniya keshlanadi (login boshqa jarayonda bo'lsa ham tez ko'rinishi uchun)
+AGENT_CACHE_MISS_TTL = float(os.getenv("AGENT_CACHE_MISS_TTL", 5))
+# agent_changed tinglovchisi ulanishi uzilganda qayta ulanishdan oldin kutish (soniya)
+AGENT_LISTENER_RETRY = float(os.getenv("AGENT_LISTENER_RETRY", 5))
+
+# Tayyor hisobot matni keshi (soniya). Savdo yozilganda kesh darhol tozalanadi; bu muddat faqat
+# bir nechta worker ishlaganda boshqa jarayondagi savdolar ko'rinishi uchun chegara
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", 300))
+
+# --- FSM (Holat Mashinasi) Saqlash Sozlamalari ---
+# "memory" (sukut, bitta jarayon), "redis" yoki "postgres" (bir nechta worker uchun), "sqlite" (lokal test/bitta server)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm_state.sqlite3")
+# FSM_STORAGE=postgres: foydalanuvchi qulfi boshqa workerda band bo'lsa qayta urinish oralig'i (soniya)
+FSM_LOCK_RETRY = float(os.getenv("FSM_LOCK_RETRY", 0.05))
+
+# --- Yangilanishlarni Parallel Qayta Ishlash ---
+# Turli foydalanuvchilarning update'lari parallel, bir foydalanuvchiniki esa navbat bilan bajariladi
+CONCURRENT_UPDATES = os.getenv("CONCURRENT_UPDATES", "true").lower() in ("1", "true", "yes")
+# Bir vaqtda bajariladigan handlerlar soni (sukut bo'yicha asyncpg havzasi max_size ga teng)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", DB_POOL_MAX_SIZE))
+
 # --- Umumiy Sozlamalar ---
 DEFAULT_UNIT = "kg"
+# Admin ro'yxatlarida (agentlar, MFYlar, parollar) bir sahifadagi yozuvlar soni
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 20))
 
 # --- Webhook (Render.com) Sozlamalari ---
 # Render avtomatik ravishda 'PORT' o'zgaruvchisini beradi
 WEB_SERVER_HOST = '0.0.0.0' # Tashqi ulanishlar uchun
 WEB_SERVER_PORT = int(os.getenv("PORT", 8080))
 
+# Ishga tushirish rejimi: "polling" (sukut) yoki "webhook" (aiohttp server)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+
 # Domen nomini .env faylidan o'qiymiz (Render Web Service url manzili)
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
-WEBHOOK_URL = os.getenv("WEBHOOK_URL") + WEBHOOK_PATH
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "") + WEBHOOK_PATH
+# Metrikalar (JSON) faqat alohida METRICS_HOST:METRICS_PORT serverida beriladi (ikkala rejimda ham);
+# ommaviy webhook serverida ochilmaydi. METRICS_PORT berilmasa metrikalar serveri ishga tushmaydi.
+METRICS_PATH = "/metrics"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT", "").isdigit() else None
+# Telegram har bir so'rovda X-Telegram-Bot-Api-Secret-Token sarlavhasida yuboradigan maxfiy kalit
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
@@ -2,12 +2,21 @@ import asyncpg
 import logging
 import polars as pl
 import asyncio
+import io
+import json
+import time
+from collections import OrderedDict
 from functools import wraps
-from config import DATABASE_URL
-from typing import List, Dict, Tuple, Optional
+from config import (
+    DATABASE_URL, DATABASE_DIRECT_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_MAX_INACTIVE_LIFETIME,
+    DB_STATEMENT_CACHE_SIZE, DB_COMMAND_TIMEOUT, DB_MAINTENANCE_TIMEOUT, SHEET_NAMES, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_FLUSH_WINDOW,
+    OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, OUTBOX_LEASE_SECONDS,
+    AGENT_CACHE_TTL, AGENT_CACHE_MISS_TTL, AGENT_CACHE_SIZE, AGENT_LISTENER_RETRY, REPORT_CACHE_TTL, ADMIN_PAGE_SIZE
+)
+from typing import List, Dict, Tuple, Optional, Union
 from datetime import datetime, timedelta, date
-
-# sheets_api moduli bu yerda ko'rsatilmagan, lekin uning chaqiruvlari kodda saqlangan.
+# Sheets qatorlari outbox orqali fon vazifasida yoziladi (VII bo'lim)
+import sheets_api
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -16,13 +25,124 @@ DB_POOL: Optional[asyncpg.Pool] = None
 
 # --- Yordamchi Funksiyalar va Dekorator ---
 
+class DBMetrics:
+    """Havzadan ulanish olish kutish vaqti va har bir DB funksiyasining bajarilish vaqtini yig'adi."""
+
+    def __init__(self):
+        self.acquire = {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+        self.queries: Dict[str, Dict[str, float]] = {}
+
+    @staticmethod
+    def _add(bucket: Dict[str, float], elapsed: float) -> None:
+        elapsed_ms = elapsed * 1000
+        bucket["count"] += 1
+        bucket["total_ms"] += elapsed_ms
+        bucket["max_ms"] = max(bucket["max_ms"], elapsed_ms)
+
+    def record_acquire(self, elapsed: float) -> None:
+        self._add(self.acquire, elapsed)
+
+    def record_query(self, name: str, elapsed: float) -> None:
+        bucket = self.queries.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        self._add(bucket, elapsed)
+
+    @staticmethod
+    def _summary(bucket: Dict[str, float]) -> Dict[str, float]:
+        count = bucket["count"]
+        return {
+            "count": count,
+            "avg_ms": round(bucket["total_ms"] / count, 2) if count else 0.0,
+            "max_ms": round(bucket["max_ms"], 2),
+        }
+
+    def snapshot(self) -> Dict:
+        return {
+            "acquire": self._summary(self.acquire),
+            "queries": {name: self._summary(b) for name, b in sorted(self.queries.items())},
+        }
+
+db_metrics = DBMetrics()
+
+def get_db_metrics() -> Dict:
+    """Havza holati (faol/bo'sh ulanishlar), ulanish olish va so'rovlar kechikishini qaytaradi."""
+    pool_info = {}
+    if DB_POOL is not None:
+        size, idle = DB_POOL.get_size(), DB_POOL.get_idle_size()
+        pool_info = {
+            "size": size,
+            "active": size - idle,
+            "idle": idle,
+            "min_size": DB_POOL.get_min_size(),
+            "max_size": DB_POOL.get_max_size(),
+        }
+    return {"pool": pool_info, **db_metrics.snapshot()}
+
+class BotConnection(asyncpg.Connection):
+    """
+    Havzadagi ulanish: PREPARED_QUERIES reyestridagi nomli so'rovlar har bir ulanishda bir marta
+    tayyorlanadi (havzaning init hooki orqali) va keyingi chaqiruvlarda SQL qayta tahlil qilinmaydi.
+    asyncpg ning ichki keshi o'chirilgan bo'lsa ham (DB_STATEMENT_CACHE_SIZE=0) ishlaydi.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements: Dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+    async def prepare_registry(self) -> None:
+        """Reyestrdagi barcha so'rovlarni tayyorlaydi. Jadval hali yaratilmagan bo'lsa (birinchi ishga tushish),
+        so'rov birinchi chaqirilganda tayyorlanadi."""
+        for name in PREPARED_QUERIES:
+            try:
+                await self.prepared(name)
+            except asyncpg.PostgresError as e:
+                logging.debug(f"{name} so'rovi hozircha tayyorlanmadi: {e}")
+        # prepare() yopilmagan yashirin tranzaksiyani qoldiradi: u yakunlanmasa bo'sh ulanish jadvallarda
+        # qulf ushlab turadi (LOCK TABLE, DDL bloklanadi). Oddiy buyruq bilan tranzaksiya yopiladi.
+        await self.execute("SELECT 1;")
+
+    async def prepared(self, name: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        """Nomli so'rovni qaytaradi (shu ulanishda hali tayyorlanmagan bo'lsa tayyorlaydi)."""
+        statement = self.statements.get(name)
+        if statement is None:
+            statement = await self.prepare(PREPARED_QUERIES[name])
+            self.statements[name] = statement
+        return statement
+
+    async def execute_prepared(self, name: str, *args) -> str:
+        """Nomli so'rovni bajaradi va holat satrini qaytaradi (masalan, 'INSERT 0 1')."""
+        statement = await self.prepared(name)
+        await statement.fetch(*args)
+        return statement.get_statusmsg()
+
+    async def fetch_prepared(self, name: str, *args) -> List[asyncpg.Record]:
+        return await (await self.prepared(name)).fetch(*args)
+
+    async def fetchrow_prepared(self, name: str, *args) -> Optional[asyncpg.Record]:
+        return await (await self.prepared(name)).fetchrow(*args)
+
+    async def fetchval_prepared(self, name: str, *args):
+        return await (await self.prepared(name)).fetchval(*args)
+
+    async def executemany_prepared(self, name: str, args: List[tuple]) -> None:
+        await (await self.prepared(name)).executemany(args)
+
 async def init_db_pool() -> Optional[asyncpg.Pool]:
     """Ulanishlar havzasini (Connection Pool) initsializatsiya qiladi. Global DB_POOL ni o'rnatadi."""
     global DB_POOL
     if DB_POOL is None:
         try:
-            # min_size va max_size ulanishlar sonini belgilaydi
-            DB_POOL = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20)
+            # min_size va max_size ulanishlar sonini belgilaydi (config.py dagi DB_POOL_* sozlamalari)
+            DB_POOL = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                # Har bir yangi ulanishda PREPARED_QUERIES bir marta tayyorlanadi
+                connection_class=BotConnection,
+                init=BotConnection.prepare_registry,
+            )
             logging.info("PostgreSQL ulanish havzasi muvaffaqiyatli initsializatsiya qilindi.")
         except Exception as e:
             logging.error(f"PostgreSQL ulanish havzasini initsializatsiya qilishda xato: {e}")
@@ -52,13 +172,138 @@ def with_connection(func):
                 return None
 
         # Pool'dan ulanishni oling va uni funktsiyaga birinchi argument sifatida yuboring (conn)
+        started = time.perf_counter()
         async with pool.acquire() as conn:
-            # Dekoratsiyalangan funksiyani 'conn' bilan chaqirish
-            return await func(conn, *args, **kwargs)
+            acquired = time.perf_counter()
+            db_metrics.record_acquire(acquired - started)
+            try:
+                # Dekoratsiyalangan funksiyani 'conn' bilan chaqirish
+                return await func(conn, *args, **kwargs)
+            finally:
+                db_metrics.record_query(func.__name__, time.perf_counter() - acquired)
     return wrapper
 
+# Keshda kalit topilmaganini bildiradi (None ham to'g'ri keshlangan qiymat bo'lishi mumkin)
+CACHE_MISS = object()
+
+class TTLCache:
+    """Muddatli (TTL) va hajmi cheklangan (LRU) xotira keshi. Hit/miss hisoblagichlari bilan."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Qiymatni qaytaradi; topilmasa yoki muddati o'tgan bo'lsa CACHE_MISS."""
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            self._data.pop(key, None)
+            self.misses += 1
+            return CACHE_MISS
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        """ttl berilsa shu yozuv uchun umumiy muddat o'rniga ishlatiladi."""
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+class SingleFlightCache:
+    """
+    Natijalar keshi (TTLCache) + bir xil kalit uchun parallel so'rovlar bitta hisoblashni kutadi (single-flight).
+    invalidate() dan keyin boshlangan so'rovlar eski (davom etayotgan) hisoblashga qo'shilmaydi.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[object, asyncio.Task] = {}
+        self.shared = 0
+
+    async def get_or_compute(self, key, compute, cacheable=lambda result: True):
+        cached = self.results.get(key)
+        if cached is not CACHE_MISS:
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute, cacheable))
+            self._inflight[key] = task
+            task.add_done_callback(self._retrieve_exception)
+        else:
+            self.shared += 1
+        # Hisoblash alohida vazifada: uni boshlagan so'rov ham, boshqa kutuvchi ham bekor qilinsa,
+        # qolgan kutuvchilar natijani baribir oladi
+        return await asyncio.shield(task)
+
+    async def _compute(self, key, compute, cacheable):
+        task = asyncio.current_task()
+        try:
+            result = await compute()
+            # Hisoblash davomida invalidate() chaqirilgan bo'lsa, natija keshlanmaydi
+            if self._inflight.get(key) is task and cacheable(result):
+                self.results.set(key, result)
+            return result
+        finally:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+
+    @staticmethod
+    def _retrieve_exception(task: asyncio.Task) -> None:
+        # Kutuvchi qolmagan bo'lsa ham "exception was never retrieved" ogohlantirishi chiqmasin
+        if not task.cancelled():
+            task.exception()
+
+    def invalidate(self) -> None:
+        self.results.clear()
+        self._inflight.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.results.stats(), "shared": self.shared}
+
 # --- I. Jadvallarni Yaratish ---
 
+# Ikkilamchi indekslar (create_tables har ishga tushganda idempotent yaratadi).
+# Qoida: indeks faqat jadvalning bir qismini o'qiydigan so'rov uchun saqlanadi. Agent qoldig'i/qarzi/pivot
+# doimiy jadvallardan (agent_stock_balance, agent_balance, daily_sales_rollup) o'qiladi; stock/sales/debt
+# ni agent bo'yicha faqat to'liq tarixni qayta hisoblash (rebuild/audit) o'qiydi - u butun jadvalni
+# skanerlaydi, shuning uchun bunday indekslar faqat har bir yozuvni sekinlashtiradi.
+INDEX_DEFINITIONS = {
+    # get_sales_export_frame (SALES_EXPORT_SQL: WHERE sale_date >= $1 ORDER BY sale_date, sale_id)
+    "idx_sales_date": "ON sales (sale_date, sale_id)",
+}
+
+# Endi ishlatilmaydigan indekslar (faqat yozishni sekinlashtiradi)
+OBSOLETE_INDEXES = [
+    # Pivot hisobot daily_sales_rollup dan o'qiladi
+    "idx_sales_date_agent",
+    # Agent qoldig'i agent_stock_balance dan, qarzdorlik agent_balance dan o'qiladi
+    "idx_stock_agent_product",
+    "idx_sales_agent_product",
+    "idx_debt_agent",
+]
+
+async def ensure_indexes(conn) -> None:
+    """INDEX_DEFINITIONS dagi barcha indekslarni (agar mavjud bo'lmasa) yaratadi, eskirganlarini o'chiradi."""
+    for index_name, definition in INDEX_DEFINITIONS.items():
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} {definition};", timeout=DB_MAINTENANCE_TIMEOUT)
+    for index_name in OBSOLETE_INDEXES:
+        await conn.execute(f"DROP INDEX IF EXISTS {index_name};", timeout=DB_MAINTENANCE_TIMEOUT)
+
 async def create_tables() -> bool:
     """Ma'lumotlar bazasi jadvallarini yaratadi (Agar mavjud bo'lmasa)."""
     pool = await init_db_pool()
@@ -123,6 +368,87 @@ async def create_tables() -> bool:
                     comment TEXT
                 );
             """)
+
+            # AGENT_STOCK_BALANCE jadvali: Agent/mahsulot bo'yicha jami berilgan va sotilgan miqdor
+            # (stock va sales ga yozish bilan bitta tranzaksiyada yangilanadi)
+            balance_table_exists = await conn.fetchval("SELECT to_regclass('agent_stock_balance') IS NOT NULL;")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS agent_stock_balance (
+                    agent_name VARCHAR(255) REFERENCES agents(agent_name),
+                    product_name VARCHAR(255) REFERENCES products(name),
+                    received_qty NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                    sold_qty NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                    PRIMARY KEY (agent_name, product_name)
+                );
+            """)
+            if not balance_table_exists:
+                # Jadval yangi yaratilgan bo'lsa, mavjud tarixdan to'ldiriladi
+                async with conn.transaction():
+                    await _rebuild_agent_stock_balance(conn)
+
+            # AGENT_BALANCE jadvali: Agentning jami stok qiymati va pul harakatlari yig'indisi
+            # (stock va debt ga yozish bilan bitta tranzaksiyada yangilanadi)
+            ledger_table_exists = await conn.fetchval("SELECT to_regclass('agent_balance') IS NOT NULL;")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS agent_balance (
+                    agent_name VARCHAR(255) PRIMARY KEY REFERENCES agents(agent_name),
+                    stock_cost NUMERIC(17, 2) NOT NULL DEFAULT 0,  -- Sum(stock.total_cost)
+                    debt_amount NUMERIC(17, 2) NOT NULL DEFAULT 0  -- Sum(debt.amount)
+                );
+            """)
+            if not ledger_table_exists:
+                async with conn.transaction():
+                    await _rebuild_agent_balance(conn)
+
+            # DAILY_SALES_ROLLUP jadvali: kunlik savdo yig'indisi (agent + sana), pivot hisobot shu jadvaldan o'qiydi
+            # (sales ga yozish bilan bitta tranzaksiyada yangilanadi)
+            rollup_table_exists = await conn.fetchval("SELECT to_regclass('daily_sales_rollup') IS NOT NULL;")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_sales_rollup (
+                    sale_date DATE NOT NULL,
+                    agent_name VARCHAR(255) REFERENCES agents(agent_name),
+                    qty_kg NUMERIC(14, 2) NOT NULL DEFAULT 0,        -- Sum(sales.qty_kg)
+                    total_amount NUMERIC(17, 2) NOT NULL DEFAULT 0,  -- Sum(sales.total_amount)
+                    PRIMARY KEY (sale_date, agent_name)
+                );
+            """)
+            if not rollup_table_exists:
+                async with conn.transaction():
+                    await _rebuild_daily_sales_rollup(conn)
+
+            # FSM_STORAGE jadvali: aiogram FSM holatlari (FSM_STORAGE=postgres bo'lganda)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    storage_key TEXT PRIMARY KEY,  -- bot:chat:user:thread:business:destiny
+                    state TEXT,
+                    data JSONB NOT NULL DEFAULT '{}',
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+
+            # OUTBOX jadvali: Sheetsga yozilishi kerak bo'lgan qatorlar (biznes yozuvi bilan bitta tranzaksiyada)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    outbox_id BIGSERIAL PRIMARY KEY,
+                    sheet_title VARCHAR(100) NOT NULL, -- Maqsad varaq (STOK_JAMI, QARZDORLIK_JAMI, YYYY/MM/01)
+                    payload JSONB NOT NULL,            -- Varaqqa yoziladigan qator
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    processed_at TIMESTAMP,            -- Eski versiyalar belgisi: endi yozilgan qator o'chiriladi
+                    last_error TEXT
+                );
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_outbox_pending
+                ON outbox (next_attempt_at, outbox_id)
+                WHERE processed_at IS NULL;
+            """)
+            # Eski versiyalarda yozilgan qatorlar o'chirilmay, belgilab qo'yilardi - ularni bir marta tozalash
+            await conn.execute("DELETE FROM outbox WHERE processed_at IS NOT NULL;", timeout=DB_MAINTENANCE_TIMEOUT)
+
+            # Hisobot so'rovlari uchun indekslar
+            await ensure_indexes(conn)
             logging.info("Barcha jadvallar muvaffaqiyatli yaratildi (yoki mavjud).")
             return True
         except Exception as e:
@@ -145,6 +471,48 @@ async def get_all_agents(conn) -> List[Dict]:
         logging.error(f"Agentlar ro'yxatini olishda xato: {e}")
         return []
 
+async def _fetch_page(conn, sql: str, *args, page: int, page_size: int) -> Dict:
+    """
+    ORDER BY li so'rovning bitta sahifasini LIMIT/OFFSET bilan oladi (sql oxirida nuqta-vergul bo'lmasligi kerak).
+    Qaytaradi: {'items': [...], 'page': joriy sahifa (0 dan), 'pages': jami sahifalar}.
+    """
+    total = await conn.fetchval(f"SELECT COUNT(*) FROM ({sql}) AS q;", *args)
+    pages = max(1, -(-total // page_size))
+    page = max(0, min(page, pages - 1))
+    n = len(args)
+    records = await conn.fetch(f"{sql} LIMIT ${n + 1} OFFSET ${n + 2};", *args, page_size, page * page_size)
+    return {'items': [dict(r) for r in records], 'page': page, 'pages': pages}
+
+@with_connection
+async def get_agents_page(conn, page: int, region_mfy: Optional[str] = None, page_size: int = ADMIN_PAGE_SIZE) -> Optional[Dict]:
+    """
+    Agentlarning agent_name bo'yicha tartiblangan bitta sahifasi (birlamchi kalit indeksi orqali).
+    region_mfy berilsa faqat shu MFY agentlari. Xato bo'lsa None.
+    """
+    try:
+        return await _fetch_page(conn, """
+            SELECT region_mfy, agent_name, phone, password, telegram_id
+            FROM agents
+            WHERE $1::VARCHAR IS NULL OR region_mfy = $1
+            ORDER BY agent_name ASC
+        """, region_mfy, page=page, page_size=page_size)
+    except Exception as e:
+        logging.error(f"Agentlar sahifasini olishda xato: {e}")
+        return None
+
+@with_connection
+async def get_mfy_page(conn, page: int, page_size: int = ADMIN_PAGE_SIZE) -> Optional[Dict]:
+    """Agentlar mavjud MFYlarning alifbo tartibidagi bitta sahifasi. Xato bo'lsa None."""
+    try:
+        return await _fetch_page(conn, """
+            SELECT DISTINCT region_mfy
+            FROM agents
+            ORDER BY region_mfy ASC
+        """, page=page, page_size=page_size)
+    except Exception as e:
+        logging.error(f"MFYlar sahifasini olishda xato: {e}")
+        return None
+
 @with_connection
 async def get_agent_by_password(conn, password: str) -> Optional[Dict]:
     """Parol orqali agentni topadi."""
@@ -159,20 +527,94 @@ async def get_agent_by_password(conn, password: str) -> Optional[Dict]:
         logging.error(f"Parol orqali agentni olishda xato: {e}")
         return None
         
+# Telegram ID -> Agent (yoki None - agent emas) keshi.
+# Agentlar o'zgarganda (yangi agent, login) barcha jarayonlar AGENT_CHANGED_CHANNEL orqali keshni tozalaydi;
+# "agent emas" natijasi faqat AGENT_CACHE_MISS_TTL soniya saqlanadi.
+agent_cache = TTLCache(maxsize=AGENT_CACHE_SIZE, ttl=AGENT_CACHE_TTL)
+AGENT_CHANGED_CHANNEL = "agent_changed"
+
+AGENT_BY_TELEGRAM_ID_SQL = """
+    SELECT region_mfy, agent_name, phone, password, telegram_id
+    FROM agents
+    WHERE telegram_id = $1;
+"""
+
 @with_connection
-async def get_agent_by_telegram_id(conn, telegram_id: int) -> Optional[Dict]:
-    """Telegram ID orqali agentni topadi."""
+async def _fetch_agent_by_telegram_id(conn, telegram_id: int) -> Optional[Dict]:
+    """Telegram ID orqali agentni bazadan oladi (xatolar chaqiruvchiga uzatiladi)."""
+    record = await conn.fetchrow_prepared("agent_by_telegram_id", telegram_id)
+    return dict(record) if record else None
+
+async def get_agent_by_telegram_id(telegram_id: int) -> Optional[Dict]:
+    """Telegram ID orqali agentni topadi (avval keshdan, topilmasa bazadan)."""
+    cached = agent_cache.get(telegram_id)
+    if cached is not CACHE_MISS:
+        return dict(cached) if cached else None
+
     try:
-        record = await conn.fetchrow("""
-            SELECT region_mfy, agent_name, phone, password, telegram_id
-            FROM agents
-            WHERE telegram_id = $1;
-        """, telegram_id)
-        return dict(record) if record else None
+        agent = await _fetch_agent_by_telegram_id(telegram_id)
     except Exception as e:
         logging.error(f"Telegram ID orqali agentni olishda xato: {e}")
         return None
 
+    # Havza mavjud bo'lmasa natija haqiqiy emas, keshlanmaydi
+    if DB_POOL is not None:
+        agent_cache.set(telegram_id, agent, ttl=None if agent else AGENT_CACHE_MISS_TTL)
+    return dict(agent) if agent else None
+
+async def notify_agent_changed(conn) -> None:
+    """
+    Boshqa jarayonlarga agentlar o'zgarganini bildiradi (NOTIFY tranzaksiya commit bo'lganda yetkaziladi).
+    Xato asosiy yozuvni bekor qilmaydi: boshqa jarayonlar keshi AGENT_CACHE_TTL dan keyin yangilanadi.
+    """
+    try:
+        await conn.execute("SELECT pg_notify($1, '');", AGENT_CHANGED_CHANNEL)
+    except Exception as e:
+        logging.error(f"{AGENT_CHANGED_CHANNEL} xabarini yuborishda xato: {e}")
+
+def _on_agent_changed(connection, pid, channel, payload) -> None:
+    agent_cache.clear()
+
+async def run_agent_cache_listener() -> None:
+    """
+    AGENT_CHANGED_CHANNEL ni alohida ulanishda tinglaydi va xabar kelganda agent keshini tozalaydi
+    (bot_main.prepare dan fon vazifasi sifatida ishga tushiriladi).
+    Ulanish uzilsa, shu vaqtdagi xabarlar o'tkazib yuborilgan bo'lishi mumkin - kesh tozalanib qayta ulanadi.
+    """
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_DIRECT_URL)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda _conn, closed=closed: closed.set())
+            await conn.add_listener(AGENT_CHANGED_CHANNEL, _on_agent_changed)
+            agent_cache.clear()
+            logging.info(f"🔔 Agent keshi {AGENT_CHANGED_CHANNEL} kanalini tinglamoqda.")
+            await closed.wait()
+            logging.warning("Agent keshi tinglovchisi ulanishi uzildi.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Agent keshi tinglovchisida xato: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        agent_cache.clear()
+        await asyncio.sleep(AGENT_LISTENER_RETRY)
+
+def get_agent_cache_stats() -> Dict[str, int]:
+    """Agent keshining hit/miss hisoblagichlarini qaytaradi."""
+    return agent_cache.stats()
+
+def get_runtime_metrics() -> Dict:
+    """Admin buyrug'i va /metrics manzili uchun barcha metrikalarni bitta lug'atda qaytaradi."""
+    return {
+        "db": get_db_metrics(),
+        "agent_cache": get_agent_cache_stats(),
+        "report_cache": report_cache.stats(),
+        "sheets_client": sheets_api.get_sheets_client_stats(),
+    }
+
 @with_connection
 async def get_agent_info(conn, agent_name: str) -> Optional[Dict]:
     """Agent nomiga ko'ra uning ma'lumotlarini qaytaradi."""
@@ -195,6 +637,9 @@ async def add_new_agent(conn, region: str, name: str, phone: str, password: str)
             INSERT INTO agents (region_mfy, agent_name, phone, password)
             VALUES ($1, $2, $3, $4);
         """, region, name, phone, password)
+        # "Agent emas" deb keshlangan yozuvlar eskiradi (boshqa jarayonlarda ham)
+        agent_cache.clear()
+        await notify_agent_changed(conn)
         return True
     except asyncpg.exceptions.UniqueViolationError:
         logging.warning(f"Agent {name} allaqachon mavjud.")
@@ -212,6 +657,9 @@ async def update_agent_telegram_id(conn, agent_name: str, telegram_id: int) -> b
             SET telegram_id = $1
             WHERE agent_name = $2;
         """, telegram_id, agent_name)
+        # Yangi ID ("agent emas" yozuvi) va agentning eski ID si keshdan tozalanadi (boshqa jarayonlarda ham)
+        agent_cache.clear()
+        await notify_agent_changed(conn)
         return result == 'UPDATE 1'
     except Exception as e:
         logging.error(f"Agent Telegram ID'sini yangilashda xato: {e}")
@@ -220,42 +668,118 @@ async def update_agent_telegram_id(conn, agent_name: str, telegram_id: int) -> b
 
 # --- III. Mahsulot Mantig'i ---
 
+class ProductCatalog:
+    """
+    Mahsulotlar katalogi xotirada: bir marta yuklanadi, nom bo'yicha O(1) qidiruv beradi.
+    Har bir o'zgarish (yuklash, qo'shish, narx yangilash) versiya hisoblagichini oshiradi,
+    shuning uchun chaqiruvchilar o'zi ko'rgan narx hali amal qilishini tekshira oladi.
+    """
+
+    def __init__(self):
+        self._products: Dict[str, Dict] = {}
+        self._sorted: Optional[List[Dict]] = None
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self.version = 0
+
+    async def ensure_loaded(self) -> bool:
+        """Katalog yuklanmagan bo'lsa, bazadan bir marta yuklaydi."""
+        if self._loaded: return True
+        async with self._lock:
+            if self._loaded: return True
+            try:
+                records = await _fetch_all_products()
+            except Exception as e:
+                logging.error(f"Mahsulotlar katalogini yuklashda xato: {e}")
+                return False
+            if records is None: return False
+
+            self._products = {r['name']: {'name': r['name'], 'price': float(r['price'])} for r in records}
+            self._sorted = None
+            self._loaded = True
+            self.version += 1
+            return True
+
+    def get(self, name: str) -> Optional[Dict]:
+        product = self._products.get(name)
+        return dict(product) if product else None
+
+    def all(self) -> List[Dict]:
+        if self._sorted is None:
+            self._sorted = [self._products[name] for name in sorted(self._products)]
+        return [dict(p) for p in self._sorted]
+
+    def put(self, name: str, price: float) -> None:
+        self._products[name] = {'name': name, 'price': float(price)}
+        self._sorted = None
+        self.version += 1
+
+    def invalidate(self) -> None:
+        """Katalogni keyingi murojaatda bazadan qayta yuklashga majburlaydi."""
+        self._loaded = False
+        self.version += 1
+
+product_catalog = ProductCatalog()
+
 @with_connection
-async def get_all_products(conn) -> List[Dict]:
-    """Barcha mahsulotlar ro'yxatini (nomi va narxi) qaytaradi."""
-    try:
-        records = await conn.fetch("""
-            SELECT name, price
-            FROM products
-            ORDER BY name ASC;
-        """)
-        return [dict(r) for r in records]
-    except Exception as e:
-        logging.error(f"Mahsulotlar ro'yxatini olishda xato: {e}")
-        return []
+async def _fetch_all_products(conn) -> Optional[List[Dict]]:
+    """Barcha mahsulotlarni bazadan oladi (xatolar chaqiruvchiga uzatiladi)."""
+    records = await conn.fetch("""
+        SELECT name, price
+        FROM products
+        ORDER BY name ASC;
+    """)
+    return [dict(r) for r in records]
 
 @with_connection
-async def get_product_info(conn, product_name: str) -> Optional[Dict]:
-    """Mahsulot nomiga ko'ra uning ma'lumotlarini qaytaradi."""
+async def _fetch_product(conn, product_name: str) -> Optional[Dict]:
+    """Bitta mahsulotni bazadan oladi (xatolar chaqiruvchiga uzatiladi)."""
+    record = await conn.fetchrow("""
+        SELECT name, price
+        FROM products
+        WHERE name = $1;
+    """, product_name)
+    return dict(record) if record else None
+
+async def get_all_products() -> List[Dict]:
+    """Barcha mahsulotlar ro'yxatini (nomi va narxi) katalogdan qaytaradi."""
+    if not await product_catalog.ensure_loaded():
+        return []
+    return product_catalog.all()
+
+async def get_product_info(product_name: str) -> Optional[Dict]:
+    """Mahsulot nomiga ko'ra uning ma'lumotlarini katalogdan qaytaradi."""
+    if not await product_catalog.ensure_loaded():
+        return None
+
+    product = product_catalog.get(product_name)
+    if product: return product
+
+    # Katalogda yo'q (masalan, boshqa worker qo'shgan) - bazadan tekshirib katalogga qo'shamiz
     try:
-        record = await conn.fetchrow("""
-            SELECT name, price
-            FROM products
-            WHERE name = $1;
-        """, product_name)
-        return dict(record) if record else None
+        record = await _fetch_product(product_name)
     except Exception as e:
         logging.error(f"Mahsulot ma'lumotlarini olishda xato: {e}")
         return None
+    if not record: return None
+
+    product_catalog.put(record['name'], record['price'])
+    return product_catalog.get(product_name)
+
+def get_product_catalog_version() -> int:
+    """Mahsulotlar katalogining joriy versiyasini qaytaradi."""
+    return product_catalog.version
 
 @with_connection
 async def add_new_product(conn, name: str, price: float) -> bool:
     """Yangi mahsulotni bazaga kiritadi."""
     try:
-        await conn.execute("""
+        stored_price = await conn.fetchval("""
             INSERT INTO products (name, price)
-            VALUES ($1, $2);
+            VALUES ($1, $2)
+            RETURNING price;
         """, name, price)
+        product_catalog.put(name, stored_price)
         return True
     except asyncpg.exceptions.UniqueViolationError:
         logging.warning(f"Mahsulot {name} allaqachon mavjud.")
@@ -268,56 +792,79 @@ async def add_new_product(conn, name: str, price: float) -> bool:
 async def update_product_price(conn, product_name: str, new_price: float) -> bool:
     """Mahsulot narxini yangilaydi."""
     try:
-        result = await conn.execute("""
+        stored_price = await conn.fetchval("""
             UPDATE products
             SET price = $1
-            WHERE name = $2;
+            WHERE name = $2
+            RETURNING price;
         """, new_price, product_name)
-        return result == 'UPDATE 1'
+        if stored_price is None: return False
+
+        product_catalog.put(product_name, stored_price)
+        return True
     except Exception as e:
         logging.error(f"Mahsulot narxini yangilashda xato: {e}")
         return False
 
 # --- IV. Hisob-kitob Mantig'i ---
 
+# Qoldiq agent_stock_balance jadvalidan birlamchi kalit (agent_name, product_name) bo'yicha o'qiladi
+AGENT_STOCK_SQL = """
+    SELECT
+        product_name,
+        received_qty,
+        sold_qty,
+        received_qty - sold_qty AS balance_qty
+    FROM agent_stock_balance
+    WHERE agent_name = $1
+      -- Agentga berilgan yoki sotilgan mahsulotlarni filtrlaymiz
+      AND (received_qty > 0 OR sold_qty > 0)
+    ORDER BY product_name ASC;
+"""
+
+# Qarzdorlik agent_balance jadvalidan bitta birlamchi kalit o'qish bilan olinadi
+AGENT_BALANCE_SQL = """
+    SELECT stock_cost + debt_amount
+    FROM agent_balance
+    WHERE agent_name = $1;
+"""
+
+# Balans ekrani uchun stok qatorlari va qarzdorlik bitta so'rovda: agentning har bir mahsuloti alohida qator,
+# current_debt esa har bir qatorda takrorlanadi (stok bo'lmasa product_name NULL bo'lgan bitta qator qaytadi)
+AGENT_DASHBOARD_SQL = """
+    SELECT
+        b.current_debt,
+        s.product_name,
+        s.received_qty,
+        s.sold_qty,
+        s.received_qty - s.sold_qty AS balance_qty
+    FROM (
+        SELECT COALESCE((SELECT stock_cost + debt_amount FROM agent_balance WHERE agent_name = $1), 0) AS current_debt
+    ) b
+    LEFT JOIN agent_stock_balance s
+        ON s.agent_name = $1
+       AND (s.received_qty > 0 OR s.sold_qty > 0)
+    ORDER BY s.product_name ASC;
+"""
+
+def split_debt(current_debt: float) -> Tuple[float, float]:
+    """Umumiy balansni (Qarzdorlik, Haqdorlik) juftligiga ajratadi."""
+    if current_debt >= 0:
+        # Agar umumiy summa musbat yoki nol bo'lsa, bu Agentning qarzi
+        return float(current_debt), 0.0 # Qarzdorlik (Agent qarz), Haqdorlik (0)
+    else:
+        # Agar umumiy summa manfiy bo'lsa, bu Kompaniyaning Agentga bo'lgan qarzi
+        return 0.0, abs(float(current_debt)) # Qarzdorlik (0), Haqdorlik (Kompaniya qarz)
+
 @with_connection
 async def calculate_agent_stock(conn, agent_name: str) -> List[Dict]:
     """
     Agentdagi har bir mahsulot bo'yicha qoldiq miqdorini (KG) hisoblaydi (Berilgan - Sotilgan).
     Faqat agentga berilgan yoki sotilgan mahsulotlarni ko'rsatadi.
+    Qiymatlar oldindan yig'ilgan agent_stock_balance jadvalidan o'qiladi.
     """
     try:
-        # StockIn: Agentga berilgan jami miqdor (quantity_kg)
-        # SalesOut: Agent sotgan jami miqdor (qty_kg)
-        records = await conn.fetch("""
-            WITH StockIn AS (
-                SELECT 
-                    product_name, 
-                    COALESCE(SUM(quantity_kg), 0) AS total_received
-                FROM stock
-                WHERE agent_name = $1
-                GROUP BY product_name
-            ),
-            SalesOut AS (
-                SELECT 
-                    product_name, 
-                    COALESCE(SUM(qty_kg), 0) AS total_sold
-                FROM sales
-                WHERE agent_name = $1
-                GROUP BY product_name
-            )
-            SELECT
-                p.name AS product_name,
-                COALESCE(si.total_received, 0) AS received_qty,
-                COALESCE(so.total_sold, 0) AS sold_qty,
-                COALESCE(si.total_received, 0) - COALESCE(so.total_sold, 0) AS balance_qty
-            FROM products p
-            LEFT JOIN StockIn si ON p.name = si.product_name
-            LEFT JOIN SalesOut so ON p.name = so.product_name
-            -- Agentga berilgan yoki sotilgan mahsulotlarni filtrlaymiz
-            WHERE COALESCE(si.total_received, 0) > 0 OR COALESCE(so.total_sold, 0) > 0
-            ORDER BY p.name ASC;
-        """, agent_name)
+        records = await conn.fetch_prepared("agent_stock", agent_name)
         
         return [dict(r) for r in records]
         
@@ -330,41 +877,156 @@ async def calculate_agent_debt(conn, agent_name: str) -> Tuple[float, float]:
     """
     Agentning jami qarzdorligi (musbat) va haqdorligi (manfiy) ni hisoblaydi.
     Qarzdorlik = Sum(Stock Cost) + Sum(Debt Amounts)
+    Ikkala yig'indi agent_balance jadvalida doimiy yangilanib boradi.
     """
-    
-    current_debt = 0.0 # Agentning kompaniyaga jami qarzi (musbat bo'lsa qarz, manfiy bo'lsa kompaniya qarz)
-    
     try:
-        # 1. STOK qiymati (Agentning boshlang'ich qarzi - total_cost)
-        stock_cost = await conn.fetchval("""
-            SELECT COALESCE(SUM(total_cost), 0)
-            FROM stock
-            WHERE agent_name = $1;
-        """, agent_name)
-        current_debt += float(stock_cost)
-        
-        # 2. QARZDORLIK tranzaksiyalari (To'lovlar/Avanslar - Amount)
-        debt_amount = await conn.fetchval("""
-            SELECT COALESCE(SUM(amount), 0)
-            FROM debt
-            WHERE agent_name = $1;
-        """, agent_name)
-        current_debt += float(debt_amount)
-
-        # Natijani ajratish:
-        if current_debt >= 0:
-            # Agar umumiy summa musbat yoki nol bo'lsa, bu Agentning qarzi
-            return float(current_debt), 0.0 # Qarzdorlik (Agent qarz), Haqdorlik (0)
-        else:
-            # Agar umumiy summa manfiy bo'lsa, bu Kompaniyaning Agentga bo'lgan qarzi
-            return 0.0, abs(float(current_debt)) # Qarzdorlik (0), Haqdorlik (Kompaniya qarz)
+        # Agentning kompaniyaga jami qarzi (musbat bo'lsa qarz, manfiy bo'lsa kompaniya qarz)
+        current_debt = await conn.fetchval_prepared("agent_balance", agent_name)
+        return split_debt(float(current_debt or 0))
             
     except Exception as e:
         logging.error(f"Agent qarzini hisoblashda xato: {e}")
         return 0.0, 0.0
 
+@with_connection
+async def get_agent_dashboard(conn, agent_name: str) -> Optional[Dict]:
+    """
+    Agentning stok qoldiqlari va qarzdorlik/haqdorligini bitta so'rov bilan qaytaradi:
+    {'stock': [calculate_agent_stock qatorlari], 'debt': float, 'credit': float}. Xato bo'lsa None.
+    """
+    try:
+        records = await conn.fetch_prepared("agent_dashboard", agent_name)
+        debt, credit = split_debt(float(records[0]['current_debt'] or 0))
+        stock = [
+            {
+                'product_name': r['product_name'],
+                'received_qty': r['received_qty'],
+                'sold_qty': r['sold_qty'],
+                'balance_qty': r['balance_qty'],
+            }
+            for r in records if r['product_name'] is not None
+        ]
+        return {'stock': stock, 'debt': debt, 'credit': credit}
+
+    except Exception as e:
+        logging.error(f"Agent balansini olishda xato: {e}")
+        return None
+
+# Barcha agentlar balansi: oldindan yig'ilgan agent_balance / agent_stock_balance jadvallaridan bitta so'rov.
+# Tarix jadvallari (sales/stock/debt) o'qilmaydi, shuning uchun vaqt agentlar*mahsulotlar soniga bog'liq.
+ALL_AGENT_BALANCES_SQL = """
+    SELECT
+        a.region_mfy,
+        a.agent_name,
+        COALESCE(b.stock_cost + b.debt_amount, 0) AS current_debt,
+        COALESCE(s.stock_qty, 0) AS stock_qty,
+        SUM(GREATEST(COALESCE(b.stock_cost + b.debt_amount, 0), 0)) OVER w AS region_debt,
+        SUM(GREATEST(-COALESCE(b.stock_cost + b.debt_amount, 0), 0)) OVER w AS region_credit,
+        SUM(COALESCE(s.stock_qty, 0)) OVER w AS region_stock
+    FROM agents a
+    LEFT JOIN agent_balance b ON b.agent_name = a.agent_name
+    LEFT JOIN (
+        SELECT agent_name, SUM(received_qty - sold_qty) AS stock_qty
+        FROM agent_stock_balance
+        GROUP BY agent_name
+    ) s ON s.agent_name = a.agent_name
+    WINDOW w AS (PARTITION BY a.region_mfy)
+    ORDER BY a.region_mfy ASC, a.agent_name ASC;
+"""
+
+@with_connection
+async def get_all_agent_balances(conn) -> Optional[List[Dict]]:
+    """
+    Barcha agentlarning qarzdorlik/haqdorligi va qo'lidagi jami stokini MFY bo'yicha tartiblab qaytaradi.
+    Har bir qatorda MFY jami (region_debt, region_credit, region_stock) ham bor. Xato bo'lsa None.
+    """
+    try:
+        records = await conn.fetch(ALL_AGENT_BALANCES_SQL)
+        balances = []
+        for r in records:
+            debt, credit = split_debt(float(r['current_debt']))
+            balances.append({
+                'region_mfy': r['region_mfy'],
+                'agent_name': r['agent_name'],
+                'debt': debt,
+                'credit': credit,
+                'stock_qty': float(r['stock_qty']),
+                'region_debt': float(r['region_debt']),
+                'region_credit': float(r['region_credit']),
+                'region_stock': float(r['region_stock']),
+            })
+        return balances
+
+    except Exception as e:
+        logging.error(f"Agentlar balansini olishda xato: {e}")
+        return None
+
 # --- V. Ma'lumot Kiritish Mantig'i (SQL + Sheets Sinkronlash) ---
 
+INSERT_OUTBOX_SQL = """
+    INSERT INTO outbox (sheet_title, payload)
+    VALUES ($1, $2::jsonb);
+"""
+
+INSERT_STOCK_SQL = """
+    INSERT INTO stock (agent_name, product_name, quantity_kg, issue_price, total_cost)
+    VALUES ($1, $2, $3, $4, $5);
+"""
+
+INSERT_DEBT_SQL = """
+    INSERT INTO debt (agent_name, transaction_type, amount, txn_date, comment)
+    VALUES ($1, $2, $3, $4, $5);
+"""
+
+# Savdo faqat narx bazadagi joriy narx bilan bir xil bo'lsa yoziladi.
+# Katalog narxni float da saqlaydi (1234.56 -> 1234.5599...), shuning uchun $4 ustun aniqligiga yaxlitlanib solishtiriladi.
+INSERT_SALE_SQL = """
+    INSERT INTO sales (agent_name, product_name, qty_kg, sale_price, total_amount, sale_date, sale_time)
+    SELECT $1, p.name, $3, p.price, $5, $6, $7
+    FROM products p
+    WHERE p.name = $2 AND p.price = $4::NUMERIC(10, 2);
+"""
+
+ADD_RECEIVED_QTY_SQL = """
+    INSERT INTO agent_stock_balance (agent_name, product_name, received_qty)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (agent_name, product_name)
+    DO UPDATE SET received_qty = agent_stock_balance.received_qty + EXCLUDED.received_qty;
+"""
+
+ADD_SOLD_QTY_SQL = """
+    INSERT INTO agent_stock_balance (agent_name, product_name, sold_qty)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (agent_name, product_name)
+    DO UPDATE SET sold_qty = agent_stock_balance.sold_qty + EXCLUDED.sold_qty;
+"""
+
+ADD_DAILY_SALES_SQL = """
+    INSERT INTO daily_sales_rollup (sale_date, agent_name, qty_kg, total_amount)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (sale_date, agent_name)
+    DO UPDATE SET qty_kg = daily_sales_rollup.qty_kg + EXCLUDED.qty_kg,
+                  total_amount = daily_sales_rollup.total_amount + EXCLUDED.total_amount;
+"""
+
+ADD_STOCK_COST_SQL = """
+    INSERT INTO agent_balance (agent_name, stock_cost)
+    VALUES ($1, $2)
+    ON CONFLICT (agent_name)
+    DO UPDATE SET stock_cost = agent_balance.stock_cost + EXCLUDED.stock_cost;
+"""
+
+ADD_DEBT_AMOUNT_SQL = """
+    INSERT INTO agent_balance (agent_name, debt_amount)
+    VALUES ($1, $2)
+    ON CONFLICT (agent_name)
+    DO UPDATE SET debt_amount = agent_balance.debt_amount + EXCLUDED.debt_amount;
+"""
+
+async def _enqueue_outbox(conn, sheet_title: str, row: list) -> None:
+    """Sheets qatorini outbox jadvaliga yozadi (chaqiruvchining tranzaksiyasi ichida)."""
+    await conn.execute_prepared("insert_outbox", sheet_title, json.dumps(row))
+
 @with_connection
 async def add_stock_transaction(conn, agent_name: str, product_name: str, qty_kg: float, issue_price: float) -> bool:
     """Agentga tovar berish amaliyotini yozadi va Sheetsga sinkronlaydi."""
@@ -372,17 +1034,21 @@ async def add_stock_transaction(conn, agent_name: str, product_name: str, qty_kg
     total_cost = qty_kg * issue_price
     
     try:
-        # 1. PostgreSQL ga yozish (Atomik operatsiya)
-        await conn.execute("""
-            INSERT INTO stock (agent_name, product_name, quantity_kg, issue_price, total_cost)
-            VALUES ($1, $2, $3, $4, $5);
-        """, agent_name, product_name, qty_kg, issue_price, total_cost)
-        
-        # 2. Sheetsga yozish (ASOSIY SINKRONLASh)
-        # Sinxron Sheets API chaqiruvini asinxron muhitni bloklamaslik uchun to_thread() yordamida ajratish
-        # 'sheets_api' modulining mavjudligi talab qilinadi.
-        # await asyncio.to_thread(sheets_api.write_stock_txn_to_sheets, agent_name, product_name, qty_kg, issue_price, total_cost)
+        async with conn.transaction():
+            # 1. PostgreSQL ga yozish (Atomik operatsiya)
+            await conn.execute_prepared("insert_stock", agent_name, product_name, qty_kg, issue_price, total_cost)
+
+            # Agent qoldig'ini yangilash (berilgan miqdor)
+            await conn.execute_prepared("add_received_qty", agent_name, product_name, qty_kg)
+
+            # Agent qarzdorligini yangilash (stok qiymati)
+            await conn.execute_prepared("add_stock_cost", agent_name, total_cost)
+            
+            # 2. Sheets qatorini outboxga yozish (fon vazifasi Sheetsga yetkazadi)
+            row = sheets_api.build_stock_row(agent_name, product_name, float(qty_kg), float(issue_price), float(total_cost))
+            await _enqueue_outbox(conn, SHEET_NAMES["STOCK"], row)
         
+        notify_outbox()
         return True
     except Exception as e:
         logging.error(f"Stok tranzaksiyasini qo'shishda xato: {e}")
@@ -399,16 +1065,19 @@ async def add_debt_payment(conn, agent_name: str, amount: float, comment: str, i
     txn_date = datetime.now().date() 
     
     try:
-        # 1. PostgreSQL ga yozish
-        await conn.execute("""
-            INSERT INTO debt (agent_name, transaction_type, amount, txn_date, comment)
-            VALUES ($1, $2, $3, $4, $5);
-        """, agent_name, txn_type, final_amount, txn_date, comment)
-        
-        # 2. Sheetsga yozish (ASOSIY SINKRONLASh)
-        txn_date_str = txn_date.strftime("%Y-%m-%d")
-        # await asyncio.to_thread(sheets_api.write_debt_txn_to_sheets, agent_name, txn_type, final_amount, txn_date_str, comment)
+        async with conn.transaction():
+            # 1. PostgreSQL ga yozish
+            await conn.execute_prepared("insert_debt", agent_name, txn_type, final_amount, txn_date, comment)
+
+            # Agent qarzdorligini yangilash (to'lov/avans)
+            await conn.execute_prepared("add_debt_amount", agent_name, final_amount)
+            
+            # 2. Sheets qatorini outboxga yozish (fon vazifasi Sheetsga yetkazadi)
+            txn_date_str = txn_date.strftime("%Y-%m-%d")
+            row = sheets_api.build_debt_row(agent_name, txn_type, float(final_amount), txn_date_str, comment)
+            await _enqueue_outbox(conn, SHEET_NAMES["DEBT"], row)
         
+        notify_outbox()
         return True
     except Exception as e:
         logging.error(f"Qarz to'lovini/Avansni qo'shishda xato: {e}")
@@ -425,169 +1094,768 @@ async def add_sales_transaction(conn, agent_name: str, product_name: str, qty_kg
     sale_time = now.time() # TIME uchun
     
     try:
-        # 1. PostgreSQL ga yozish
-        await conn.execute("""
-            INSERT INTO sales (agent_name, product_name, qty_kg, sale_price, total_amount, sale_date, sale_time)
-            VALUES ($1, $2, $3, $4, $5, $6, $7);
-        """, agent_name, product_name, qty_kg, sale_price, total_amount, sale_date, sale_time)
-        
-        # 2. Sheetsga yozish (ASOSIY SINKRONLASh - Dinamik oylik varaqqa)
-        sale_date_str = sale_date.strftime("%Y-%m-%d")
-        sale_time_str = sale_time.strftime("%H:%M:%S")
-        # await asyncio.to_thread(sheets_api.write_sale_to_sheets, agent_name, product_name, qty_kg, sale_price, total_amount, sale_date_str, sale_time_str)
+        async with conn.transaction():
+            # 1. PostgreSQL ga yozish (faqat narx bazadagi joriy narx bilan bir xil bo'lsa)
+            result = await conn.execute_prepared(
+                "insert_sale", agent_name, product_name, qty_kg, sale_price, total_amount, sale_date, sale_time
+            )
+            if result != 'INSERT 0 1':
+                # Narx boshqa joyda (masalan, boshqa worker) o'zgargan: eskirgan narx bilan savdo yozilmaydi
+                logging.warning(f"{product_name} narxi eskirgan ({sale_price}). Savdo yozilmadi, katalog yangilanadi.")
+                product_catalog.invalidate()
+                return False
 
+            # Agent qoldig'ini yangilash (sotilgan miqdor)
+            await conn.execute_prepared("add_sold_qty", agent_name, product_name, qty_kg)
+
+            # Kunlik savdo yig'indisini yangilash (pivot hisobot uchun)
+            await conn.execute_prepared("add_daily_sales", sale_date, agent_name, qty_kg, total_amount)
+            
+            # 2. Sheets qatorini outboxga yozish (Dinamik oylik varaq - fon vazifasi yetkazadi)
+            sale_date_str = sale_date.strftime("%Y-%m-%d")
+            sale_time_str = sale_time.strftime("%H:%M:%S")
+            row = sheets_api.build_sale_row(
+                agent_name, product_name, float(qty_kg), float(sale_price), float(total_amount), sale_date_str, sale_time_str
+            )
+            await _enqueue_outbox(conn, sheets_api.monthly_sheet_title(now), row)
+
+        # Pivot hisobot endi eskirgan
+        report_cache.invalidate()
+        notify_outbox()
         return True
     except Exception as e:
         logging.error(f"Savdo tranzaksiyasini qo'shishda xato: {e}")
         return False
 
-# --- VI. KUNLIK SAVDO PIVOT HISOBOTI (Monospace) ---
+# --- V.1 Agent Qoldiqlari Jadvalini Qayta Qurish / Tekshirish ---
+
+# To'liq tarixdan qoldiqni qayta hisoblash (agent_stock_balance bilan solishtirish uchun)
+STOCK_BALANCE_RECOMPUTE_SQL = """
+    SELECT agent_name, product_name, SUM(received) AS received_qty, SUM(sold) AS sold_qty
+    FROM (
+        SELECT agent_name, product_name, quantity_kg AS received, 0 AS sold FROM stock
+        UNION ALL
+        SELECT agent_name, product_name, 0 AS received, qty_kg AS sold FROM sales
+    ) AS history
+    WHERE agent_name IS NOT NULL AND product_name IS NOT NULL
+    GROUP BY agent_name, product_name
+"""
+
+async def _rebuild_agent_stock_balance(conn) -> int:
+    """agent_stock_balance jadvalini stock va sales tarixidan qaytadan to'ldiradi (tranzaksiya ichida chaqiriladi)."""
+    # Parallel add_* tranzaksiyalari qayta qurish tugaguncha kutadi
+    await conn.execute("LOCK TABLE agent_stock_balance IN EXCLUSIVE MODE;", timeout=DB_MAINTENANCE_TIMEOUT)
+    await conn.execute("DELETE FROM agent_stock_balance;", timeout=DB_MAINTENANCE_TIMEOUT)
+    result = await conn.execute(f"""
+        INSERT INTO agent_stock_balance (agent_name, product_name, received_qty, sold_qty)
+        {STOCK_BALANCE_RECOMPUTE_SQL};
+    """, timeout=DB_MAINTENANCE_TIMEOUT)
+    return int(result.split()[-1])
+
+@with_connection
+async def rebuild_agent_stock_balance(conn) -> Optional[int]:
+    """agent_stock_balance jadvalini to'liq tarixdan qayta quradi. Yozilgan qatorlar sonini qaytaradi."""
+    try:
+        async with conn.transaction():
+            count = await _rebuild_agent_stock_balance(conn)
+        logging.info(f"agent_stock_balance qayta qurildi: {count} ta qator.")
+        return count
+    except Exception as e:
+        logging.error(f"Agent qoldiqlari jadvalini qayta qurishda xato: {e}")
+        return None
 
 @with_connection
-async def get_daily_sales_pivot_report(conn) -> Optional[str]:
+async def verify_agent_stock_balance(conn) -> Optional[List[Dict]]:
     """
-    Kunlik savdo ma'lumotlarini bazadan oladi, Polars yordamida pivot qiladi va Telegram uchun qulay monospace formatda chiqaradi.
-    Faqat oxirgi 31 kunlik ma'lumotni ko'rsatadi.
+    agent_stock_balance ni to'liq tarixdan qayta hisoblangan qiymat bilan solishtiradi.
+    Farq (drift) bor qatorlarni qaytaradi; bo'sh ro'yxat - jadval to'g'ri, None - tekshiruv bajarilmadi (xato).
     """
     try:
-        # 1. Barcha sotuv va agent ma'lumotlarini olish
-        thirty_one_days_ago = (datetime.now() - timedelta(days=31)).date()
-        
-        records = await conn.fetch("""
+        records = await conn.fetch(f"""
+            WITH expected AS ({STOCK_BALANCE_RECOMPUTE_SQL})
             SELECT
-                s.agent_name,
-                a.region_mfy,
-                s.qty_kg,
-                s.sale_date
-            FROM sales s
-            JOIN agents a ON s.agent_name = a.agent_name
-            WHERE s.sale_date >= $1  
-            ORDER BY s.sale_date DESC;
-        """, thirty_one_days_ago) # SQL filteri orqali tezlashtirish
-
-        if not records: return "⚠️ Savdo ma'lumotlari oxirgi 31 kun ichida topilmadi."
-
-        # 2. Polars DataFrame yaratish
-        data = [dict(r) for r in records]
-        df = pl.DataFrame(data)
-
-        # 3. Ustunlarni qayta nomlash va ma'lumot turlarini sozlash
-        df = df.rename({'region_mfy': 'MFY_Nomi', 'agent_name': 'Agent_Ismi', 'qty_kg': 'Qty_KG'})
-        
-        df = df.with_columns(
-            pl.col('Qty_KG').cast(pl.Float64, strict=False).fill_null(0.0),
-            pl.col('sale_date').cast(pl.Date, strict=False)
-        )
-        
-        # Sanani 'MM-DD' formatiga o'tkazish uchun yangi ustun yaratish
-        df = df.with_columns(
-            pl.col('sale_date').dt.strftime('%m-%d').alias('Day_MMDD')
-        )
-        
-        # 4. Pivot jadvalni yaratish (Polars Pivot usuli)
-        # Eager DataFrame ustida .pivot() chaqiriladi, shuning uchun .collect() ORIB TASHLANDI.
-        pivot_df = df.pivot(
-            index=['MFY_Nomi', 'Agent_Ismi'], 
-            columns='Day_MMDD', 
-            values='Qty_KG', 
-            aggregate_function='sum'
+                COALESCE(b.agent_name, e.agent_name) AS agent_name,
+                COALESCE(b.product_name, e.product_name) AS product_name,
+                COALESCE(b.received_qty, 0) AS stored_received,
+                COALESCE(e.received_qty, 0) AS expected_received,
+                COALESCE(b.sold_qty, 0) AS stored_sold,
+                COALESCE(e.sold_qty, 0) AS expected_sold
+            FROM agent_stock_balance b
+            FULL OUTER JOIN expected e
+                ON b.agent_name = e.agent_name AND b.product_name = e.product_name
+            WHERE COALESCE(b.received_qty, 0) <> COALESCE(e.received_qty, 0)
+               OR COALESCE(b.sold_qty, 0) <> COALESCE(e.sold_qty, 0)
+            ORDER BY 1, 2;
+        """, timeout=DB_MAINTENANCE_TIMEOUT)
+        return [dict(r) for r in records]
+    except Exception as e:
+        logging.error(f"Agent qoldiqlari jadvalini tekshirishda xato: {e}")
+        return None
+
+# --- V.2 Agent Qarzdorlik Jadvalini Qayta Qurish / Audit ---
+
+# To'liq tarixdan qarzdorlikni qayta hisoblash (agent_balance bilan solishtirish uchun)
+AGENT_BALANCE_RECOMPUTE_SQL = """
+    SELECT agent_name, SUM(stock_cost) AS stock_cost, SUM(debt_amount) AS debt_amount
+    FROM (
+        SELECT agent_name, total_cost AS stock_cost, 0 AS debt_amount FROM stock
+        UNION ALL
+        SELECT agent_name, 0 AS stock_cost, amount AS debt_amount FROM debt
+    ) AS history
+    WHERE agent_name IS NOT NULL
+    GROUP BY agent_name
+"""
+
+async def _rebuild_agent_balance(conn) -> int:
+    """agent_balance jadvalini stock va debt tarixidan qaytadan to'ldiradi (tranzaksiya ichida chaqiriladi)."""
+    await conn.execute("LOCK TABLE agent_balance IN EXCLUSIVE MODE;", timeout=DB_MAINTENANCE_TIMEOUT)
+    await conn.execute("DELETE FROM agent_balance;", timeout=DB_MAINTENANCE_TIMEOUT)
+    result = await conn.execute(f"""
+        INSERT INTO agent_balance (agent_name, stock_cost, debt_amount)
+        {AGENT_BALANCE_RECOMPUTE_SQL};
+    """, timeout=DB_MAINTENANCE_TIMEOUT)
+    return int(result.split()[-1])
+
+@with_connection
+async def rebuild_agent_balance(conn) -> Optional[int]:
+    """agent_balance jadvalini to'liq tarixdan qayta quradi. Yozilgan qatorlar sonini qaytaradi."""
+    try:
+        async with conn.transaction():
+            count = await _rebuild_agent_balance(conn)
+        logging.info(f"agent_balance qayta qurildi: {count} ta qator.")
+        return count
+    except Exception as e:
+        logging.error(f"Agent qarzdorlik jadvalini qayta qurishda xato: {e}")
+        return None
+
+@with_connection
+async def audit_agent_balance(conn) -> Optional[List[Dict]]:
+    """
+    Har bir agent uchun agent_balance dagi doimiy balansni to'liq qayta hisoblash bilan solishtiradi.
+    Farq bor agentlarni qaytaradi; bo'sh ro'yxat - barcha balanslar to'g'ri, None - audit bajarilmadi (xato).
+    """
+    try:
+        records = await conn.fetch(f"""
+            WITH expected AS ({AGENT_BALANCE_RECOMPUTE_SQL})
+            SELECT
+                COALESCE(b.agent_name, e.agent_name) AS agent_name,
+                COALESCE(b.stock_cost, 0) + COALESCE(b.debt_amount, 0) AS stored_balance,
+                COALESCE(e.stock_cost, 0) + COALESCE(e.debt_amount, 0) AS expected_balance
+            FROM agent_balance b
+            FULL OUTER JOIN expected e ON b.agent_name = e.agent_name
+            WHERE COALESCE(b.stock_cost, 0) <> COALESCE(e.stock_cost, 0)
+               OR COALESCE(b.debt_amount, 0) <> COALESCE(e.debt_amount, 0)
+            ORDER BY 1;
+        """, timeout=DB_MAINTENANCE_TIMEOUT)
+        return [dict(r) for r in records]
+    except Exception as e:
+        logging.error(f"Agent qarzdorlik auditida xato: {e}")
+        return None
+
+# --- V.3 Kunlik Savdo Yig'indisini Qayta Qurish (Backfill) ---
+
+# Kunlik savdo yig'indisini to'liq sales tarixidan hisoblash
+DAILY_ROLLUP_RECOMPUTE_SQL = """
+    SELECT sale_date, agent_name, SUM(qty_kg) AS qty_kg, SUM(total_amount) AS total_amount
+    FROM sales
+    WHERE agent_name IS NOT NULL AND sale_date IS NOT NULL
+    GROUP BY sale_date, agent_name
+"""
+
+async def _rebuild_daily_sales_rollup(conn) -> int:
+    """daily_sales_rollup jadvalini sales tarixidan qaytadan to'ldiradi (tranzaksiya ichida chaqiriladi)."""
+    await conn.execute("LOCK TABLE daily_sales_rollup IN EXCLUSIVE MODE;", timeout=DB_MAINTENANCE_TIMEOUT)
+    await conn.execute("DELETE FROM daily_sales_rollup;", timeout=DB_MAINTENANCE_TIMEOUT)
+    result = await conn.execute(f"""
+        INSERT INTO daily_sales_rollup (sale_date, agent_name, qty_kg, total_amount)
+        {DAILY_ROLLUP_RECOMPUTE_SQL};
+    """, timeout=DB_MAINTENANCE_TIMEOUT)
+    return int(result.split()[-1])
+
+@with_connection
+async def rebuild_daily_sales_rollup(conn) -> Optional[int]:
+    """daily_sales_rollup jadvalini to'liq savdo tarixidan qayta quradi. Yozilgan qatorlar sonini qaytaradi."""
+    try:
+        async with conn.transaction():
+            count = await _rebuild_daily_sales_rollup(conn)
+        report_cache.invalidate()
+        logging.info(f"daily_sales_rollup qayta qurildi: {count} ta qator.")
+        return count
+    except Exception as e:
+        logging.error(f"Kunlik savdo yig'indisini qayta qurishda xato: {e}")
+        return None
+
+# --- VI. KUNLIK SAVDO PIVOT HISOBOTI (Monospace) ---
+
+async def fetch_frame(conn, sql: str, *args, dtypes: Dict[str, pl.DataType]) -> pl.DataFrame:
+    """
+    So'rov natijasini COPY ... TO STDOUT (CSV) orqali to'g'ridan-to'g'ri Polars DataFrame ga yuklaydi.
+    Qatorlar Python obyektlariga (Record/dict/Decimal) aylantirilmaydi: Polars CSV ni o'zi ustunlarga ajratadi,
+    dtypes esa NUMERIC ustunlarni darhol Float64 ga o'qiydi.
+    """
+    buffer = io.BytesIO()
+    # COPY (...) ichida nuqta-vergul bo'lmasligi kerak
+    await conn.copy_from_query(sql.strip().rstrip(';'), *args, output=buffer, format='csv', header=True)
+    buffer.seek(0)
+    return pl.read_csv(buffer, dtypes=dtypes)
+
+# Pivot hisobot ustunlarining Polars turlari (fetch_frame uchun)
+PIVOT_SALES_DTYPES = {
+    'agent_name': pl.Utf8,
+    'region_mfy': pl.Utf8,
+    'qty_kg': pl.Float64,
+    'sale_date': pl.Date,
+}
+
+# Oldindan yig'ilgan kunlik qatorlar: ko'pi bilan agentlar soni x 31 ta qator o'qiladi
+PIVOT_SALES_SQL = """
+    SELECT
+        r.agent_name,
+        a.region_mfy,
+        r.qty_kg,
+        r.sale_date
+    FROM daily_sales_rollup r
+    JOIN agents a ON r.agent_name = a.agent_name
+    WHERE r.sale_date >= $1
+    ORDER BY r.sale_date DESC;
+"""
+
+def _format_kg(column: str, width: int) -> pl.Expr:
+    """Miqdor ustunini 1 o'nli kasr bilan ("12.5", "-1.5") o'ngga tekislangan matnga aylantiradi (Polars ifodasi)."""
+    value = pl.col(column)
+    # Butun bo'lish manfiy sonda pastga yaxlitlaydi (-15 // 10 = -2), shuning uchun mutlaq qiymat formatlanadi
+    tenths = (value.abs() * 10).round(0).cast(pl.Int64)
+    sign = pl.when((value < 0) & (tenths > 0)).then(pl.lit("-")).otherwise(pl.lit(""))
+    return pl.format("{}{}.{}", sign, tenths // 10, tenths % 10).str.pad_start(width)
+
+def build_pivot_frame(
+    source: Union[pl.DataFrame, pl.LazyFrame],
+    index: Dict[str, pl.Expr],
+    column: pl.Expr,
+    value: pl.Expr,
+    total_col: str,
+    predicate: Optional[pl.Expr] = None,
+) -> Tuple[pl.DataFrame, List[str]]:
+    """
+    Umumiy pivot hisobot quruvchi (agent/kun, mahsulot/kun, MFY/kun va h.k. uchun).
+    index: qator ustunlari (nom -> ifoda), column: pivot ustuni nomini beruvchi matn ifodasi, value: yig'iladigan miqdor.
+
+    Filtr, kerakli ustunlarni tanlash va guruhlash bitta LazyFrame rejasida bajariladi; eager qadam faqat pivot.
+    Pivotdan keyingi to'ldirish, jami ustuni, tartiblash va ustunlar tartibi ham bitta rejada collect() qilinadi.
+    Qaytaradi: (index + [total_col] + tartiblangan pivot ustunlari) jadvali va pivot ustunlari ro'yxati.
+    """
+    label_cols = list(index)
+    lf = source.lazy()
+    if predicate is not None:
+        lf = lf.filter(predicate)
+
+    grouped = (
+        lf.select(
+            *[expr.alias(name) for name, expr in index.items()],
+            column.alias('__column'),
+            value.cast(pl.Float64, strict=False).fill_null(0.0).alias('__value'),
         )
-        
-        # 4a. NULL qiymatlarni nolga to'ldirish (Agar pivotda yaratilgan bo'lsa)
-        pivot_df = pivot_df.fill_null(0.0)
-        
-        # 5. 'Jami Savdo' ustunini qo'shish
-        date_cols_temp = [col for col in pivot_df.columns if col not in ['MFY_Nomi', 'Agent_Ismi']]
-        
-        pivot_df = pivot_df.with_columns(
-            pl.sum_horizontal(pl.col(date_cols_temp)).alias('Jami_Savdo')
+        .group_by(label_cols + ['__column'])
+        .agg(pl.col('__value').sum())
+        .collect()
+    )
+    if grouped.is_empty():
+        return pl.DataFrame(schema={**{name: pl.Utf8 for name in label_cols}, total_col: pl.Float64}), []
+
+    # Yagona eager qadam: har bir (index, ustun) juftligi guruhlashdan keyin bitta qator
+    pivot_df = grouped.pivot(index=label_cols, columns='__column', values='__value', aggregate_function=None)
+    pivot_cols = sorted(col for col in pivot_df.columns if col not in index)
+
+    result = (
+        pivot_df.lazy()
+        .with_columns(pl.col(pivot_cols).fill_null(0.0))
+        .with_columns(pl.sum_horizontal(pivot_cols).alias(total_col))
+        .sort(label_cols)
+        .select(label_cols + [total_col] + pivot_cols)
+        .collect()
+    )
+    return result, pivot_cols
+
+def format_pivot_table(
+    pivot_df: pl.DataFrame,
+    labels: Dict[str, Tuple[str, int, int]],
+    total_col: str,
+    pivot_cols: List[str],
+    total_width: int = 8,
+    cell_width: int = 5,
+) -> List[str]:
+    """
+    build_pivot_frame natijasini monospace qatorlarga aylantiradi: sarlavha, ma'lumotlar, jami qatori.
+    labels: qator ustuni -> (sarlavha, min kenglik, max kenglik). Qatorlar Polars ifodalari bilan formatlanadi.
+    """
+    label_cols = list(labels)
+
+    # Ustun kengliklari: eng uzun qiymat, lekin [min, max] oralig'ida
+    widths = pivot_df.select(
+        pl.col(col).str.len_chars().max().clip(min_w, max_w) for col, (_, min_w, max_w) in labels.items()
+    ).row(0)
+
+    # Jami qatori: birinchi ustunda "Yig'indi", qolgan qator ustunlarida "JAMI", raqamlar - ustun yig'indisi
+    totals = [pl.lit("Yig'indi" if i == 0 else "JAMI").alias(col) for i, col in enumerate(label_cols)]
+    totals += [pl.col(col).sum() for col in [total_col] + pivot_cols]
+
+    lines = (
+        pl.concat([pivot_df.lazy(), pivot_df.lazy().select(totals)], how='vertical')
+        .select(
+            pl.concat_str(
+                [pl.col(col).fill_null("").str.pad_end(width) for col, width in zip(label_cols, widths)]
+                + [_format_kg(total_col, total_width)]
+                + [_format_kg(col, cell_width) for col in pivot_cols],
+                separator=" | "
+            ).alias('line')
         )
+        .collect()['line']
+        .to_list()
+    )
 
-        # 6. Tartiblash
-        pivot_df = pivot_df.sort(['MFY_Nomi', 'Agent_Ismi'], descending=[False, False])
-        
-        # 7. Ustunlarni tartibga keltirish (Barcha 31 kunlik ustunlar olinadi)
-        date_cols = [col for col in pivot_df.columns if col not in ['MFY_Nomi', 'Agent_Ismi', 'Jami_Savdo']]
-        date_cols.sort() # Eski sanadan yangi sanaga tartiblash
+    header_line = " | ".join(
+        [title.ljust(width) for (title, _, _), width in zip(labels.values(), widths)]
+        + ["JAMI".rjust(total_width)]
+        + [col.center(cell_width) for col in pivot_cols]
+    )
+    separator = "-" * len(header_line)
+    return [header_line, separator, *lines[:-1], separator, lines[-1]]
 
-        final_cols_order = ['MFY_Nomi', 'Agent_Ismi', 'Jami_Savdo'] + date_cols
-        pivot_df = pivot_df.select(final_cols_order)
+def render_daily_sales_pivot(df: Union[pl.DataFrame, pl.LazyFrame]) -> str:
+    """
+    sales ustunlari (agent_name, region_mfy, qty_kg, sale_date) dan 31 kunlik pivot hisobot matnini yasaydi.
+    [31 KUN UCHUN QISQARTIRILGAN USTUN KENGILIKLARI]: MFY 8..10, Agent 12..15, Jami 8, sanalar 5 (MM-DD).
+    """
+    pivot_df, date_cols = build_pivot_frame(
+        df,
+        index={'MFY_Nomi': pl.col('region_mfy'), 'Agent_Ismi': pl.col('agent_name')},
+        # Sanani 'MM-DD' formatiga o'tkazish (eski sanadan yangi sanaga tartiblanadi)
+        column=pl.col('sale_date').cast(pl.Date, strict=False).dt.strftime('%m-%d'),
+        value=pl.col('qty_kg'),
+        total_col='Jami_Savdo',
+    )
+    report_lines = format_pivot_table(
+        pivot_df,
+        labels={'MFY_Nomi': ("MFY NOMI", 8, 10), 'Agent_Ismi': ("AGENT ISMI", 12, 15)},
+        total_col='Jami_Savdo',
+        pivot_cols=date_cols,
+    )
 
-        data_rows = pivot_df.to_dict(as_series=False) 
-        
-        # 8. Matnni Monospace formatida shakllantirish (Telegram uchun)
-        
-        # [UZGARISH: 31 KUN UCHUN QISQARTIRILGAN USTUN KENGILIKLARI]
-        col_widths = {
-            'MFY_Nomi': min(max(max(len(str(x)) for x in data_rows['MFY_Nomi']) if data_rows['MFY_Nomi'] else 8, 8), 10),
-            'Agent_Ismi': min(max(max(len(str(x)) for x in data_rows['Agent_Ismi']) if data_rows['Agent_Ismi'] else 12, 12), 15),
-            'Jami_Savdo': 8 
-        }
-        for col in date_cols:
-            col_widths[col] = 5 # Sanalar uchun 5 belgiga qisqartirildi (MM-DD)
-        
-        report_lines = []
-        
-        # --- Sarlavha (Head) ---
-        header_line = ""
-        header_line += "MFY NOMI".ljust(col_widths['MFY_Nomi']) + " | "
-        header_line += "AGENT ISMI".ljust(col_widths['Agent_Ismi']) + " | "
-        header_line += "JAMI".rjust(col_widths['Jami_Savdo'])
-        
-        for col in date_cols:
-            header_line += " | " + col.center(col_widths[col])
-            
-        report_lines.append(header_line)
-        
-        # --- Ajratuvchi chiziq ---
-        separator = "-" * len(header_line)
-        report_lines.append(separator)
-
-        # --- Ma'lumot Qatorlari ---
-        for i in range(len(data_rows['MFY_Nomi'])):
-            line = ""
-            mfy_name = data_rows['MFY_Nomi'][i]
-            agent_name = data_rows['Agent_Ismi'][i]
-            jami_savdo = data_rows['Jami_Savdo'][i]
-            
-            line += str(mfy_name).ljust(col_widths['MFY_Nomi']) + " | "
-            line += str(agent_name).ljust(col_widths['Agent_Ismi']) + " | "
-            
-            # Raqamni formatlash (1 o'nli kasr)
-            jami_savdo_kg = f"{jami_savdo:.1f}"
-            line += jami_savdo_kg.rjust(col_widths['Jami_Savdo'])
-            
-            for col in date_cols:
-                qty_val = data_rows.get(col, [0.0] * len(data_rows['MFY_Nomi']))[i]
-                qty_val_formatted = f"{qty_val:.1f}"
-                line += " | " + qty_val_formatted.rjust(col_widths[col])
-                    
-            report_lines.append(line)
-
-        # --- Jami Yig'indi Qatori (Total Sum) ---
-        total_sum = sum(data_rows['Jami_Savdo'])
-        
-        total_line = ""
-        total_line += "Yig'indi".ljust(col_widths['MFY_Nomi']) + " | "
-        total_line += "JAMI".ljust(col_widths['Agent_Ismi']) + " | "
-        total_line += f"{total_sum:.1f}".rjust(col_widths['Jami_Savdo'])
-        
-        for col in date_cols:
-            daily_sum = sum(data_rows.get(col, [0.0] * len(data_rows['MFY_Nomi'])))
-            total_line += " | " + f"{daily_sum:.1f}".rjust(col_widths[col])
-            
-        report_lines.append(separator)
-        report_lines.append(total_line)
+    final_report = f"📊 **Oxirgi Oylik ({len(date_cols)} kunlik) Savdo Hisoboti** ({datetime.now().strftime('%Y-%m-%d')} holatiga):\n\n"
+    final_report += "```\n"
+    final_report += "\n".join(report_lines)
+    final_report += "\n```"
 
+    return final_report
 
-        final_report = f"📊 **Oxirgi Oylik ({len(date_cols)} kunlik) Savdo Hisoboti** ({datetime.now().strftime('%Y-%m-%d')} holatiga):\n\n"
-        final_report += "```\n"
-        final_report += "\n".join(report_lines)
-        final_report += "\n```"
-        
-        return final_report
-        
+@with_connection
+async def _build_daily_sales_pivot_report(conn) -> str:
+    """
+    Kunlik savdo ma'lumotlarini bazadan oladi, Polars yordamida pivot qiladi va Telegram uchun qulay monospace formatda chiqaradi.
+    Faqat oxirgi 31 kunlik ma'lumotni ko'rsatadi. Xatolar chaqiruvchiga (get_daily_sales_pivot_report) uzatiladi.
+    """
+    # Kunlik savdo yig'indilari va agent MFY ma'lumotlarini olish (COPY orqali ustunli yuklash)
+    thirty_one_days_ago = (datetime.now() - timedelta(days=31)).date()
+    df = await fetch_frame(conn, PIVOT_SALES_SQL, thirty_one_days_ago, dtypes=PIVOT_SALES_DTYPES)
+
+    if df.is_empty(): return "⚠️ Savdo ma'lumotlari oxirgi 31 kun ichida topilmadi."
+
+    return render_daily_sales_pivot(df)
+
+# Tayyor pivot hisobot matni (kalit: bugungi sana). add_sales_transaction yozgan zahoti tozalanadi.
+report_cache = SingleFlightCache(maxsize=4, ttl=REPORT_CACHE_TTL)
+
+async def get_daily_sales_pivot_report() -> str:
+    """
+    31 kunlik pivot hisobotini qaytaradi. Yangi savdo bo'lmaguncha keshdagi matn qaytariladi,
+    bir vaqtda kelgan so'rovlar esa bitta hisoblash natijasini kutadi.
+    """
+    try:
+        report = await report_cache.get_or_compute(
+            date.today().isoformat(),
+            _build_daily_sales_pivot_report,
+            # DB havzasi mavjud bo'lmasa (None) natija keshlanmaydi
+            cacheable=lambda result: result is not None,
+        )
+        return report or "⚠️ Ma'lumotlar bazasiga ulanib bo'lmadi. Keyinroq urinib ko'ring."
     except Exception as e:
-        # Xatoni o'chirganimizdan so'ng, endi bu yerda boshqa xatolar ushlanadi.
         logging.error(f"Polars 31 kunlik Pivot hisobotini yaratishda xato: {e}")
         return f"⚠️ Hisobotni tayyorlashda ichki xato yuz berdi: {e}"
+
+
+# --- VII. OUTBOX: SHEETS SINKRONLASH FON VAZIFASI ---
+
+# Yangi outbox yozuvi paydo bo'lganda fon vazifasini uyg'otish uchun
+_outbox_wakeup: Optional[asyncio.Event] = None
+# Oxirgi bo'shatishdan beri shu jarayonda yozilgan qatorlar OUTBOX_BATCH_SIZE ga yetganda o'rnatiladi
+_outbox_full: Optional[asyncio.Event] = None
+_outbox_pending = 0
+
+def notify_outbox() -> None:
+    """Outbox fon vazifasiga yangi yozuv borligini bildiradi."""
+    global _outbox_pending
+    if _outbox_wakeup is None: return
+    _outbox_pending += 1
+    _outbox_wakeup.set()
+    if _outbox_pending >= OUTBOX_BATCH_SIZE:
+        _outbox_full.set()
+
+@with_connection
+async def claim_outbox_batch(conn, limit: int = OUTBOX_BATCH_SIZE) -> List[Dict]:
+    """
+    Yozilishi kerak bo'lgan outbox yozuvlarini oladi va ularni OUTBOX_LEASE_SECONDS muddatga band qiladi.
+    SKIP LOCKED tufayli bir nechta worker bir xil yozuvni olmaydi.
+    """
+    try:
+        records = await conn.fetch("""
+            UPDATE outbox
+            SET next_attempt_at = NOW() + make_interval(secs => $2)
+            WHERE outbox_id IN (
+                SELECT outbox_id
+                FROM outbox
+                WHERE processed_at IS NULL AND next_attempt_at <= NOW()
+                ORDER BY outbox_id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING outbox_id, sheet_title, payload, attempts;
+        """, limit, OUTBOX_LEASE_SECONDS)
+        return sorted((dict(r) for r in records), key=lambda r: r['outbox_id'])
+    except Exception as e:
+        logging.error(f"Outbox yozuvlarini olishda xato: {e}")
+        return []
+
+@with_connection
+async def mark_outbox_results(conn, done_ids: List[int], failed_ids: List[int], error: str = "") -> bool:
+    """
+    Sheetsga yozilgan yozuvlarni outboxdan o'chiradi (jadval faqat kutilayotgan qatorlar hajmida qoladi),
+    xato berganlarini orqaga surib qayta rejalashtiradi.
+    """
+    try:
+        async with conn.transaction():
+            if done_ids:
+                await conn.execute("""
+                    DELETE FROM outbox
+                    WHERE outbox_id = ANY($1::bigint[]);
+                """, done_ids)
+            if failed_ids:
+                await conn.execute("""
+                    UPDATE outbox
+                    SET attempts = attempts + 1,
+                        last_error = $2,
+                        next_attempt_at = NOW() + make_interval(secs => LEAST($3 * power(2, attempts), $4))
+                    WHERE outbox_id = ANY($1::bigint[]);
+                """, failed_ids, error, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX)
+        return True
+    except Exception as e:
+        logging.error(f"Outbox natijalarini belgilashda xato: {e}")
+        return False
+
+async def drain_outbox_once() -> int:
+    """Bir paket outbox yozuvlarini varaqlar bo'yicha guruhlab Sheetsga yozadi. Olingan yozuvlar sonini qaytaradi."""
+    claimed = await claim_outbox_batch()
+    if not claimed: return 0
+
+    batches: Dict[str, List[list]] = {}
+    ids_by_sheet: Dict[str, List[int]] = {}
+    for item in claimed:
+        payload = item['payload']
+        row = json.loads(payload) if isinstance(payload, str) else payload
+        batches.setdefault(item['sheet_title'], []).append(row)
+        ids_by_sheet.setdefault(item['sheet_title'], []).append(item['outbox_id'])
+
+    failed = await asyncio.to_thread(sheets_api.append_rows_batch_sync, batches)
+
+    done_ids = [i for title, ids in ids_by_sheet.items() if title not in failed for i in ids]
+    failed_ids = [i for title in failed for i in ids_by_sheet[title]]
+    error = f"Sheetsga yozilmadi: {', '.join(failed)}" if failed else ""
+    await mark_outbox_results(done_ids, failed_ids, error)
+
+    if failed_ids:
+        logging.warning(f"Outbox: {len(failed_ids)} ta yozuv keyinroq qayta yuboriladi.")
+    return len(claimed)
+
+async def run_outbox_drain() -> None:
+    """
+    Outbox jadvalini doimiy bo'shatib turuvchi fon vazifasi (bot_main.prepare dan ishga tushiriladi).
+    Yangi yozuv uyg'otgach OUTBOX_FLUSH_WINDOW soniya (yoki OUTBOX_BATCH_SIZE qator yig'ilguncha) kutiladi,
+    shuning uchun har bir savdo alohida append_rows chaqiruviga aylanmaydi.
+    """
+    global _outbox_wakeup, _outbox_full, _outbox_pending
+    _outbox_wakeup = asyncio.Event()
+    _outbox_full = asyncio.Event()
+    logging.info("📤 Outbox fon vazifasi ishga tushdi.")
+
+    while True:
+        _outbox_wakeup.clear()
+        _outbox_full.clear()
+        _outbox_pending = 0
+        try:
+            processed = await drain_outbox_once()
+        except Exception as e:
+            logging.error(f"Outbox fon vazifasida xato: {e}")
+            processed = 0
+
+        # To'liq paket olingan bo'lsa, navbatda yana yozuv bo'lishi mumkin
+        if processed >= OUTBOX_BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(_outbox_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            # Boshqa workerlar yozgan yoki qayta urinish vaqti kelgan qatorlar uchun davriy tekshiruv
+            continue
+
+        # Yig'ish oynasi: paket to'lsa darhol, aks holda oyna tugagach yoziladi
+        try:
+            await asyncio.wait_for(_outbox_full.wait(), timeout=OUTBOX_FLUSH_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+
+
+# --- VIII. SO'ROV REJALARINI TEKSHIRISH (EXPLAIN) ---
+
+# Ushbu jadvallarda Seq Scan bo'lsa, so'rov indeksdan foydalanmayapti deb hisoblanadi
+PLAN_CHECKED_TABLES = {"sales", "stock", "debt", "agent_stock_balance", "agent_balance", "daily_sales_rollup"}
+
+# Tekshiruv uchun vaqtinchalik (ROLLBACK qilinadigan) ma'lumotlar
+PLAN_CHECK_SEED_SQL = """
+    INSERT INTO agents (agent_name, region_mfy, password)
+    SELECT '__plan_check_' || g, 'MFY ' || (g % 20), 'pc' || g
+    FROM generate_series(1, 200) g;
+
+    INSERT INTO products (name, price)
+    SELECT '__plan_check_p' || g, 1000
+    FROM generate_series(1, 20) g;
+"""
+
+# Vaqtinchalik jadvallarda SERIAL standart qiymati yo'q (haqiqiy ketma-ketliklar surilmasligi uchun),
+# shuning uchun ID lar aniq beriladi
+PLAN_CHECK_SEED_ROWS_SQL = [
+    """
+    INSERT INTO sales (sale_id, agent_name, product_name, qty_kg, sale_price, total_amount, sale_date, sale_time)
+    SELECT g, '__plan_check_' || (g % 200 + 1), '__plan_check_p' || (g % 20 + 1), 1, 1000, 1000,
+           CURRENT_DATE - (g % 730), '12:00'
+    FROM generate_series(1, $1) g;
+    """,
+    """
+    INSERT INTO stock (entry_id, agent_name, product_name, quantity_kg, issue_price, total_cost)
+    SELECT g, '__plan_check_' || (g % 200 + 1), '__plan_check_p' || (g % 20 + 1), 1, 900, 900
+    FROM generate_series(1, $1) g;
+    """,
+    """
+    INSERT INTO debt (debt_id, agent_name, transaction_type, amount, txn_date, comment)
+    SELECT g, '__plan_check_' || (g % 200 + 1), 'Qoplash', -900, CURRENT_DATE - (g % 730), NULL
+    FROM generate_series(1, $1) g;
+    """,
+]
+
+# Sintetik tekshiruv uchun pg_temp da nusxasi yaratiladigan jadvallar (indekslari bilan)
+PLAN_CHECK_SCRATCH_TABLES = [
+    "agents", "products", "sales", "stock", "debt", "agent_stock_balance", "agent_balance", "daily_sales_rollup",
+]
+
+def _report_query_samples(agent_name: str) -> Dict[str, tuple]:
+    """Tekshiriladigan hisobot so'rovlari va ularning namunaviy parametrlari."""
+    thirty_one_days_ago = (datetime.now() - timedelta(days=31)).date()
+    return {
+        "calculate_agent_stock": (AGENT_STOCK_SQL, (agent_name,)),
+        "calculate_agent_debt": (AGENT_BALANCE_SQL, (agent_name,)),
+        "get_agent_dashboard": (AGENT_DASHBOARD_SQL, (agent_name,)),
+        "get_daily_sales_pivot_report": (PIVOT_SALES_SQL, (thirty_one_days_ago,)),
+    }
+
+def _find_seq_scans(plan: Dict) -> List[str]:
+    """EXPLAIN (FORMAT JSON) rejasidan tekshiriladigan jadvallardagi Seq Scan tugunlarini topadi."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in PLAN_CHECKED_TABLES:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found.extend(_find_seq_scans(child))
+    return found
+
+@with_connection
+async def check_report_query_plans(conn, seed_rows: int = 0) -> Optional[Dict[str, List[str]]]:
+    """
+    Har bir hisobot so'rovi uchun EXPLAIN bajaradi va Seq Scan qilingan jadvallarni qaytaradi.
+    Bo'sh ro'yxat - so'rov indeksdan foydalanmoqda.
+
+    Kichik jadvallarda Postgres Seq Scanni to'g'ri tanlashi mumkin, shuning uchun seed_rows > 0 bo'lsa
+    jadvallarning indeksli vaqtinchalik (pg_temp) nusxalari yaratiladi, ularga sintetik qatorlar qo'shiladi
+    va faqat shu nusxalar ANALYZE qilinadi. pg_temp search_path da birinchi turgani uchun so'rovlar
+    o'zgartirilmasdan nusxalarni o'qiydi; haqiqiy jadvallar, ularning statistikasi (reltuples ham) va
+    ketma-ketliklariga tegilmaydi. Nusxalar tranzaksiya tugashi bilan o'chiriladi.
+    """
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        sample_agent = None
+        if seed_rows > 0:
+            for table in PLAN_CHECK_SCRATCH_TABLES:
+                await conn.execute(f"CREATE TEMP TABLE {table} (LIKE {table} INCLUDING INDEXES) ON COMMIT DROP;")
+            await conn.execute(PLAN_CHECK_SEED_SQL)
+            for seed_sql in PLAN_CHECK_SEED_ROWS_SQL:
+                await conn.execute(seed_sql, seed_rows, timeout=DB_MAINTENANCE_TIMEOUT)
+            # Sintetik stok/savdo qoldiq jadvallariga ham tushishi kerak
+            await conn.execute(f"""
+                INSERT INTO agent_stock_balance (agent_name, product_name, received_qty, sold_qty)
+                SELECT agent_name, product_name, received_qty, sold_qty
+                FROM ({STOCK_BALANCE_RECOMPUTE_SQL}) AS seeded;
+            """, timeout=DB_MAINTENANCE_TIMEOUT)
+            await conn.execute(f"""
+                INSERT INTO agent_balance (agent_name, stock_cost, debt_amount)
+                SELECT agent_name, stock_cost, debt_amount
+                FROM ({AGENT_BALANCE_RECOMPUTE_SQL}) AS seeded;
+            """, timeout=DB_MAINTENANCE_TIMEOUT)
+            await conn.execute(f"""
+                INSERT INTO daily_sales_rollup (sale_date, agent_name, qty_kg, total_amount)
+                SELECT sale_date, agent_name, qty_kg, total_amount
+                FROM ({DAILY_ROLLUP_RECOMPUTE_SQL}) AS seeded;
+            """, timeout=DB_MAINTENANCE_TIMEOUT)
+            scratch_tables = ", ".join(f"pg_temp.{table}" for table in PLAN_CHECK_SCRATCH_TABLES)
+            await conn.execute(f"ANALYZE {scratch_tables};", timeout=DB_MAINTENANCE_TIMEOUT)
+            sample_agent = "__plan_check_1"
+        else:
+            sample_agent = await conn.fetchval("SELECT agent_name FROM agents ORDER BY agent_name LIMIT 1;") or ""
+
+        results = {}
+        for query_name, (sql, params) in _report_query_samples(sample_agent).items():
+            plan_json = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *params)
+            plan = json.loads(plan_json) if isinstance(plan_json, str) else plan_json
+            results[query_name] = _find_seq_scans(plan[0]["Plan"])
+
+            if results[query_name]:
+                logging.error(f"{query_name} so'rovi Seq Scan qilmoqda: {', '.join(results[query_name])}")
+        return results
+    except Exception as e:
+        logging.error(f"So'rov rejalarini tekshirishda xato: {e}")
+        return None
+    finally:
+        # Vaqtinchalik nusxalar (va ularning statistikasi) shu yerda o'chiriladi
+        await tr.rollback()
+
+
+# --- IX. FSM HOLATLARINI SAQLASH (storage.PostgresStorage uchun) ---
+
+# FSM_STORAGE=postgres bo'lganda har bir update'da bajariladi (tayyorlangan so'rovlar reyestrida)
+FSM_RECORD_SQL = """
+    SELECT state, data
+    FROM fsm_storage
+    WHERE storage_key = $1;
+"""
+
+UPSERT_FSM_SQL = """
+    INSERT INTO fsm_storage (storage_key, state, data, updated_at)
+    VALUES ($1, $2, $3::jsonb, NOW())
+    ON CONFLICT (storage_key)
+    DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW();
+"""
+
+@with_connection
+async def fetch_fsm_record(conn, storage_key: str) -> Optional[Dict]:
+    """FSM kaliti bo'yicha holat va ma'lumotlarni oladi (xatolar chaqiruvchiga uzatiladi)."""
+    record = await conn.fetchrow_prepared("fsm_record", storage_key)
+    if not record: return None
+    data = record['data']
+    return {'state': record['state'], 'data': json.loads(data) if isinstance(data, str) else data}
+
+@with_connection
+async def upsert_fsm_records(conn, records: List[tuple]) -> bool:
+    """(storage_key, state, data) yozuvlarini bitta paket bilan saqlaydi (xatolar chaqiruvchiga uzatiladi)."""
+    await conn.executemany_prepared("upsert_fsm", [(key, state, json.dumps(data)) for key, state, data in records])
+    return True
+
+# Tayyorlangan so'rovlar reyestri: nom -> SQL. BotConnection har bir ulanishda ularni bir marta tayyorlaydi.
+PREPARED_QUERIES: Dict[str, str] = {
+    "agent_by_telegram_id": AGENT_BY_TELEGRAM_ID_SQL,
+    "agent_stock": AGENT_STOCK_SQL,
+    "agent_balance": AGENT_BALANCE_SQL,
+    "agent_dashboard": AGENT_DASHBOARD_SQL,
+    "insert_stock": INSERT_STOCK_SQL,
+    "insert_debt": INSERT_DEBT_SQL,
+    "insert_sale": INSERT_SALE_SQL,
+    "add_received_qty": ADD_RECEIVED_QTY_SQL,
+    "add_sold_qty": ADD_SOLD_QTY_SQL,
+    "add_daily_sales": ADD_DAILY_SALES_SQL,
+    "add_stock_cost": ADD_STOCK_COST_SQL,
+    "add_debt_amount": ADD_DEBT_AMOUNT_SQL,
+    "insert_outbox": INSERT_OUTBOX_SQL,
+    "fsm_record": FSM_RECORD_SQL,
+    "upsert_fsm": UPSERT_FSM_SQL,
+}
+
+
+# --- X. HISOBOTLARNI FAYLGA EKSPORT (CSV / XLSX / Parquet) ---
+
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+
+# Xom savdolar: COPY orqali ustunli yuklanadi (bir yillik savdo ham Python qator obyektlarisiz)
+SALES_EXPORT_SQL = """
+    SELECT
+        s.sale_id,
+        s.sale_date,
+        s.sale_time,
+        a.region_mfy,
+        s.agent_name,
+        s.product_name,
+        s.qty_kg,
+        s.sale_price,
+        s.total_amount
+    FROM sales s
+    LEFT JOIN agents a ON s.agent_name = a.agent_name
+    WHERE s.sale_date >= $1
+    ORDER BY s.sale_date, s.sale_id;
+"""
+
+SALES_EXPORT_DTYPES = {
+    'sale_id': pl.Int64,
+    'sale_date': pl.Date,
+    'sale_time': pl.Utf8,
+    'region_mfy': pl.Utf8,
+    'agent_name': pl.Utf8,
+    'product_name': pl.Utf8,
+    'qty_kg': pl.Float64,
+    'sale_price': pl.Float64,
+    'total_amount': pl.Float64,
+}
+
+@with_connection
+async def get_sales_export_frame(conn, since: date) -> Optional[pl.DataFrame]:
+    """since sanasidan boshlab barcha savdolarni (agent MFY bilan) DataFrame ko'rinishida qaytaradi. Xato bo'lsa None."""
+    try:
+        return await fetch_frame(conn, SALES_EXPORT_SQL, since, dtypes=SALES_EXPORT_DTYPES)
+    except Exception as e:
+        logging.error(f"Savdolarni eksport uchun yuklashda xato: {e}")
+        return None
+
+@with_connection
+async def get_pivot_export_frame(conn) -> Optional[pl.DataFrame]:
+    """31 kunlik pivot jadvalini (to'liq YYYY-MM-DD sana ustunlari bilan) qaytaradi. Xato bo'lsa None."""
+    try:
+        thirty_one_days_ago = (datetime.now() - timedelta(days=31)).date()
+        df = await fetch_frame(conn, PIVOT_SALES_SQL, thirty_one_days_ago, dtypes=PIVOT_SALES_DTYPES)
+        pivot_df, _ = build_pivot_frame(
+            df,
+            index={'MFY': pl.col('region_mfy'), 'Agent': pl.col('agent_name')},
+            column=pl.col('sale_date').dt.strftime('%Y-%m-%d'),
+            value=pl.col('qty_kg'),
+            total_col='Jami_KG',
+        )
+        return pivot_df
+    except Exception as e:
+        logging.error(f"Pivot jadvalini eksport uchun tayyorlashda xato: {e}")
+        return None
+
+def frame_to_bytes(df: pl.DataFrame, file_format: str) -> bytes:
+    """DataFrame ni xotiradagi buferga (vaqtinchalik faylsiz) CSV / XLSX / Parquet ko'rinishida yozadi."""
+    buffer = io.BytesIO()
+    if file_format == "csv":
+        df.write_csv(buffer)
+    elif file_format == "xlsx":
+        # xlsxwriter kutubxonasi kerak (requirements.txt)
+        df.write_excel(buffer, worksheet="Hisobot", autofit=True)
+    elif file_format == "parquet":
+        df.write_parquet(buffer)
+    else:
+        raise ValueError(f"Noma'lum eksport formati: {file_format}")
+    return buffer.getvalue()
+
@@ -0,0 +1,71 @@
+# ==============================================================================
+# middlewares.py
+# Routerlar uchun aiogram middleware'lari
+# ==============================================================================
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+import database
+
+
+class AgentMiddleware(BaseMiddleware):
+    """
+    Har bir update uchun agentni bir marta (keshdan yoki bazadan) aniqlaydi va
+    handlerlarga 'agent' argumenti sifatida uzatadi (agent bo'lmasa None).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        data["agent"] = await database.get_agent_by_telegram_id(user.id) if user else None
+        return await handler(event, data)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Parallel qayta ishlanayotgan update'lar sonini `concurrency` bilan cheklaydi (asyncpg havzasi to'lib qolmasligi uchun).
+    Bir foydalanuvchi update'larining tartibi bu yerda emas, Dispatcher(events_isolation=...)
+    orqali saqlanadi: u FSM holati o'qilishidan oldin qulflaydi. Shu sababli navbatdagi update'lar limitni band qilmaydi.
+    Dispatcher ning update outer middleware'i sifatida ulanadi.
+    """
+
+    def __init__(self, concurrency: int):
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class FSMWriteBatchMiddleware(BaseMiddleware):
+    """
+    PostgresStorage ga bitta update davomida yozilgan FSM holati va ma'lumotlarini update tugaganda
+    bitta upsert bilan yozadi (update_data har chaqirilganda alohida so'rov bo'lmaydi).
+    Dispatcher ning update outer middleware'i sifatida ulanadi - FSM events_isolation qulfi ichida ishlaydi,
+    shuning uchun yozuv qulf bo'shashidan oldin bazada bo'ladi; webhook javobi ham shundan keyin qaytadi.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.storage.batch_writes():
+            return await handler(event, data)
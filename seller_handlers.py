@@ -12,6 +12,8 @@ from aiogram.exceptions import TelegramBadRequest
 import database 
 import keyboards as kb 
 from config import ADMIN_IDS, DEFAULT_UNIT 
+from middlewares import AgentMiddleware
+from typing import Dict, Optional
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,6 +21,10 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Router yaratish
 seller_router = Router()
 
+# Agent har bir update uchun bir marta aniqlanadi va handlerlarga 'agent' sifatida uzatiladi
+seller_router.message.outer_middleware(AgentMiddleware())
+seller_router.callback_query.outer_middleware(AgentMiddleware())
+
 # ==============================================================================
 # II. FSM (Holat Mashinasi)
 # ==============================================================================
@@ -45,12 +51,12 @@ class PaymentState(StatesGroup):
 # Faqat Admin bo'lmagan foydalanuvchilar uchun
 @seller_router.message(CommandStart())
 @seller_router.message(F.text == "🔝 Asosiy Menu")
-async def cmd_start_seller(message: Message, state: FSMContext):
+async def cmd_start_seller(message: Message, state: FSMContext, agent: Optional[Dict]):
     """Botni ishga tushirish, Telegram ID orqali avtomatik login qilish."""
     await state.clear()
     
-    # 1. Telegram ID orqali agentni topish
-    agent_data = await database.get_agent_by_telegram_id(message.from_user.id)
+    # 1. Telegram ID orqali topilgan agent (AgentMiddleware)
+    agent_data = agent
     
     if agent_data:
         # Agent topildi (avtomatik login)
@@ -105,11 +111,11 @@ async def process_login_password(message: Message, state: FSMContext):
 # ==============================================================================
 
 @seller_router.message(F.text == "💰 Balans & Statistika")
-async def show_seller_balance(message: Message):
+async def show_seller_balance(message: Message, agent: Optional[Dict]):
     """Agentning stok va qarz holatini batafsil ko'rsatadi."""
     
     # 1. Loginni tekshirish
-    agent_data = await database.get_agent_by_telegram_id(message.from_user.id)
+    agent_data = agent
     if not agent_data:
         return await message.answer("Siz tizimga kirmagansiz yoki agent sifatida ro'yxatdan o'tmagansiz. /start")
 
@@ -119,10 +125,12 @@ async def show_seller_balance(message: Message):
     # Ushbu funksiya uzoq ishlashi mumkin, shuning uchun yuklanmoqda xabarini berish maqsadga muvofiq
     sent_message = await message.answer("Hisob-kitoblar tayyorlanmoqda, iltimos kuting...")
 
-    stock_data = await database.calculate_agent_stock(agent_name)
-    
-    # 3. Qarzni hisoblash
-    debt, credit = await database.calculate_agent_debt(agent_name)
+    # 3. Stok va qarz bitta so'rov bilan olinadi
+    dashboard = await database.get_agent_dashboard(agent_name)
+    if dashboard is None:
+        return await sent_message.edit_text("❌ Balans ma'lumotlarini yuklashda xato yuz berdi. Keyinroq urinib ko'ring.")
+    stock_data = dashboard['stock']
+    debt, credit = dashboard['debt'], dashboard['credit']
 
     report_parts = []
     total_stock_balance = sum(item['balance_qty'] for item in stock_data)
@@ -198,10 +206,10 @@ async def show_seller_balance(message: Message):
 # ==============================================================================
 
 @seller_router.message(F.text == "🛍️ Savdo Kiritish")
-async def start_sell(message: Message, state: FSMContext):
+async def start_sell(message: Message, state: FSMContext, agent: Optional[Dict]):
     """Savdo kiritish jarayonini boshlaydi, mahsulotlarni ko'rsatadi."""
     
-    agent_data = await database.get_agent_by_telegram_id(message.from_user.id)
+    agent_data = agent
     if not agent_data:
         return await message.answer("Siz tizimga kirmagansiz. /start")
 
@@ -240,7 +248,12 @@ async def select_quantity(callback: CallbackQuery, state: FSMContext):
 
     default_price = product_info['price']
     
-    await state.update_data(product_name=product_name, sale_price=default_price)
+    # Katalog versiyasi saqlanadi: yakunlashda narx hali amal qilishini tekshirish uchun
+    await state.update_data(
+        product_name=product_name,
+        sale_price=default_price,
+        catalog_version=database.get_product_catalog_version()
+    )
     
     try:
         await callback.message.edit_text(
@@ -276,6 +289,17 @@ async def finish_sell_with_default_price(message: Message, state: FSMContext):
     agent_name = data['agent_name']
     product_name = data['product_name']
     sale_price = data['sale_price'] # Standart narx state'dan olinadi
+    price_note = ""
+
+    # Mahsulot tanlangandan keyin katalog o'zgargan bo'lsa, narxni qayta olamiz (eskirgan narx ishlatilmaydi)
+    if data.get('catalog_version') != database.get_product_catalog_version():
+        product_info = await database.get_product_info(product_name)
+        if not product_info or product_info.get('price', 0) <= 0:
+            await state.clear()
+            return await message.answer("❌ Tanlangan mahsulot narxi bazada topilmadi. Qayta urinib ko'ring.", reply_markup=kb.seller_main_kb)
+        if product_info['price'] != sale_price:
+            sale_price = product_info['price']
+            price_note = "\n⚠️ *Narx admin tomonidan yangilangan, yangi narx qo'llandi.*"
     
     # Savdoni bazaga kiritish
     success = await database.add_sales_transaction(agent_name, product_name, qty_kg, sale_price)
@@ -289,7 +313,8 @@ async def finish_sell_with_default_price(message: Message, state: FSMContext):
             f"Tovar: **{product_name}**\n"
             f"Miqdor: **{qty_kg:.1f} {DEFAULT_UNIT}**\n"
             f"Narx: **{sale_price:,.0f} UZS** (Admin narxi)\n"
-            f"Jami: **{total_amount:,.0f} UZS**",
+            f"Jami: **{total_amount:,.0f} UZS**"
+            f"{price_note}",
             reply_markup=kb.seller_main_kb,
             parse_mode="Markdown"
         )
@@ -305,10 +330,10 @@ async def finish_sell_with_default_price(message: Message, state: FSMContext):
 # ==============================================================================
 
 @seller_router.message(F.text == "💸 To'lov Kiritish")
-async def start_debt_payment(message: Message, state: FSMContext):
+async def start_debt_payment(message: Message, state: FSMContext, agent: Optional[Dict]):
     """To'lov kiritish jarayonini boshlaydi."""
     
-    agent_data = await database.get_agent_by_telegram_id(message.from_user.id)
+    agent_data = agent
     if not agent_data:
         return await message.answer("Siz tizimga kirmagansiz. /start")
 
@@ -1,53 +1,209 @@
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 import json
-from config import SPREADSHEET_ID, SHEET_NAMES, SERVICE_ACCOUNT_JSON
-
-# Asyncio bilan sinxron kodni bloklanmasdan ishlatish uchun
-import asyncio
+from typing import Dict, List, Optional
+from config import SPREADSHEET_ID, SHEET_NAMES, SERVICE_ACCOUNT_JSON, SHEETS_PRECREATE_DAYS
 
 logging.basicConfig(level=logging.INFO)
 
 # ==============================================================================
-# I. GOOGLE SHEETSGA ULANISH FUNKSIYASI (SINXRON - o'zgarmadi)
+# I. GOOGLE SHEETSGA ULANISH (SINXRON - jarayon bo'yicha yagona keshlangan ulanish)
 # ==============================================================================
 
+def _build_spreadsheet() -> tuple:
+    """Yangi Credentials yaratadi, avtorizatsiya qiladi va jadvalni ochadi."""
+    creds_json = json.loads(SERVICE_ACCOUNT_JSON)
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    creds = Credentials.from_service_account_info(creds_json, scopes=scope) 
+    
+    client = gspread.authorize(creds)
+    spreadsheet = client.open_by_key(SPREADSHEET_ID)
+    return spreadsheet, creds
+
+def is_auth_error(error: Exception) -> bool:
+    """Xato avtorizatsiya (401/403) yoki token bilan bog'liqligini aniqlaydi."""
+    if isinstance(error, RefreshError):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, "status_code", None) in (401, 403)
+    return False
+
+def is_stale_worksheet_error(error: Exception) -> bool:
+    """Keshdagi varaq obyekti eskirganini aniqlaydi (varaq o'chirilgan/qayta nomlangan: 404 yoki diapazon 400)."""
+    if isinstance(error, gspread.WorksheetNotFound):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, "status_code", None) in (400, 404)
+    return False
+
+class SheetsClientCache:
+    """
+    Jarayon bo'yicha yagona Spreadsheet obyektini saqlaydi.
+    Token muddati tugaganda uni faqat kerak bo'lganda yangilaydi,
+    avtorizatsiya xatosida esa ulanishni qaytadan quradi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spreadsheet: Optional[gspread.Spreadsheet] = None
+        self._creds: Optional[Credentials] = None
+        self._stats = {
+            "authorizations": 0,   # To'liq qayta avtorizatsiyalar (authorize + open_by_key)
+            "reuses": 0,           # Keshdagi obyektdan foydalanishlar
+            "token_refreshes": 0,  # Faqat OAuth tokenni yangilashlar
+            "invalidations": 0,    # Avtorizatsiya xatosi sababli tashlab yuborishlar
+        }
+
+    def get(self) -> gspread.Spreadsheet:
+        """Keshdagi Spreadsheet'ni qaytaradi (kerak bo'lsa yaratadi yoki tokenni yangilaydi)."""
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet, self._creds = _build_spreadsheet()
+                self._stats["authorizations"] += 1
+                logging.info("Google Sheets ulanishi yaratildi (avtorizatsiya).")
+                return self._spreadsheet
+
+            if not self._creds.valid:
+                # Token muddati tugagan: faqat tokenni yangilaymiz, ulanish saqlanadi
+                self._creds.refresh(GoogleAuthRequest())
+                self._stats["token_refreshes"] += 1
+
+            self._stats["reuses"] += 1
+            return self._spreadsheet
+
+    def invalidate(self) -> None:
+        """Keshdagi ulanishni tashlab yuboradi; keyingi get() qaytadan avtorizatsiya qiladi."""
+        with self._lock:
+            if self._spreadsheet is not None:
+                self._stats["invalidations"] += 1
+            self._spreadsheet = None
+            self._creds = None
+        # Eski ulanishga bog'langan varaq obyektlari ham yaroqsiz
+        worksheet_cache.clear()
+
+    def invalidate_on_auth_error(self, error: Exception) -> None:
+        """Agar xato avtorizatsiya bilan bog'liq bo'lsa, ulanishni qayta qurishga belgilaydi."""
+        if is_auth_error(error):
+            logging.warning(f"Sheets avtorizatsiya xatosi, ulanish qayta quriladi: {error}")
+            self.invalidate()
+
+    def stats(self) -> Dict[str, int]:
+        """Qayta avtorizatsiya va qayta foydalanish hisoblagichlarini qaytaradi."""
+        with self._lock:
+            return dict(self._stats)
+
+sheets_client = SheetsClientCache()
+
 def get_sheets_client():
-    """Google Sheetsga ulanishni ta'minlaydi (SERVICE_ACCOUNT_JSON orqali)."""
+    """Google Sheetsga ulanishni ta'minlaydi (SERVICE_ACCOUNT_JSON orqali, keshlangan)."""
     try:
         if not SPREADSHEET_ID or not SERVICE_ACCOUNT_JSON:
             logging.error("SPREADSHEET_ID yoki SERVICE_ACCOUNT_JSON o'rnatilmagan.")
             return None
             
-        creds_json = json.loads(SERVICE_ACCOUNT_JSON)
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = Credentials.from_service_account_info(creds_json, scopes=scope) 
-        
-        client = gspread.authorize(creds)
-        spreadsheet = client.open_by_key(SPREADSHEET_ID)
-        return spreadsheet
+        return sheets_client.get()
     except Exception as e:
         logging.error(f"Google Sheetsga ulanishda xato: {e}")
+        sheets_client.invalidate_on_auth_error(e)
         return None
 
+def get_sheets_client_stats() -> Dict[str, int]:
+    """Sheets ulanish keshining statistikasini qaytaradi."""
+    return sheets_client.stats()
+
 # ==============================================================================
-# II. YORDAMCHI FUNKSIYALAR (SINXRON - o'zgarmadi)
+# II. YORDAMCHI FUNKSIYALAR (SINXRON - varaqlar keshi)
 # ==============================================================================
 
-def get_or_create_monthly_sheet(spreadsheet: gspread.Spreadsheet) -> gspread.Worksheet:
+def monthly_sheet_title(moment: Optional[datetime] = None) -> str:
+    """Berilgan sana uchun oylik varaq nomini qaytaradi (YYYY/MM/01)."""
+    moment = moment or datetime.now()
+    # Varaq nomi har doim oyning 1-sanasini bildiradi.
+    return moment.replace(day=1).strftime("%Y/%m/%d")
+
+class WorksheetCache:
     """
-    Joriy oy uchun varaqni topadi. 
-    Varaq nomi har doim joriy oyning 1-sanasini aks ettiradi (YYYY/MM/01).
+    Worksheet obyektlarini varaq nomi bo'yicha saqlaydi.
+    Keshda yo'q varaq faqat bitta oqim tomonidan qidiriladi/yaratiladi, shuning uchun
+    parallel asyncio.to_thread chaqiruvlari dublikat varaq yaratmaydi va qayta so'rov yubormaydi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._worksheets: Dict[str, gspread.Worksheet] = {}
+
+    def get_or_load(self, sheet_title: str, loader) -> Optional[gspread.Worksheet]:
+        worksheet = self._worksheets.get(sheet_title)
+        if worksheet is not None:
+            return worksheet
+
+        with self._lock:
+            # Qulf kutilayotganda boshqa oqim varaqni yuklagan bo'lishi mumkin
+            worksheet = self._worksheets.get(sheet_title)
+            if worksheet is None:
+                worksheet = loader()
+                if worksheet is not None:
+                    self._worksheets[sheet_title] = worksheet
+            return worksheet
+
+    def invalidate(self, sheet_title: str) -> None:
+        """Bitta varaqni keshdan chiqaradi; keyingi get_or_load uni Sheetsdan qayta yuklaydi."""
+        with self._lock:
+            self._worksheets.pop(sheet_title, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._worksheets.clear()
+
+worksheet_cache = WorksheetCache()
+
+def _worksheet_loader(spreadsheet: gspread.Spreadsheet, sheet_title: str):
+    """Varaq nomiga mos yuklovchi: doimiy varaq topiladi, oylik savdo varag'i (YYYY/MM/01) kerak bo'lsa yaratiladi."""
+    if sheet_title in SHEET_NAMES.values():
+        return lambda: spreadsheet.worksheet(sheet_title)
+    return lambda: _fetch_or_create_monthly_sheet(spreadsheet, sheet_title)
+
+def get_or_create_monthly_sheet(spreadsheet: gspread.Spreadsheet, sheet_title: Optional[str] = None) -> gspread.Worksheet:
+    """
+    Joriy (yoki berilgan nomdagi) oy uchun varaqni keshdan oladi, bo'lmasa topadi yoki yaratadi.
+    Varaq nomi har doim oyning 1-sanasini aks ettiradi (YYYY/MM/01).
     """
-    now = datetime.now()
-    
-    # Varaq nomi har doim joriy oyning 1-sanasini bildiradi.
-    first_day_of_month = now.replace(day=1)
-    sheet_title = first_day_of_month.strftime("%Y/%m/%d") 
     # Natija har doim: YYYY/MM/01 (masalan, 2025/11/01)
-    
+    sheet_title = sheet_title or monthly_sheet_title()
+    return worksheet_cache.get_or_load(sheet_title, _worksheet_loader(spreadsheet, sheet_title))
+
+def append_rows_to_sheet(spreadsheet: gspread.Spreadsheet, sheet_title: str, rows: List[list]) -> bool:
+    """
+    Qatorlarni keshdagi varaqqa bitta append_rows bilan yozadi. Varaq o'chirilgan yoki qayta nomlangan bo'lsa,
+    u keshdan chiqariladi, qayta yuklanadi (oylik varaq qayta yaratiladi) va yozuv bir marta takrorlanadi.
+    Varaq topilmasa False; boshqa xatolar chaqiruvchiga uzatiladi.
+    """
+    for attempt in range(2):
+        worksheet = worksheet_cache.get_or_load(sheet_title, _worksheet_loader(spreadsheet, sheet_title))
+        if not worksheet: return False
+        try:
+            worksheet.append_rows(rows)
+            return True
+        except Exception as e:
+            if attempt or not is_stale_worksheet_error(e): raise
+            logging.warning(f"{sheet_title} varag'i keshda eskirgan, qayta yuklanmoqda: {e}")
+            worksheet_cache.invalidate(sheet_title)
+    return False
+
+def ensure_next_month_sheet(spreadsheet: gspread.Spreadsheet) -> None:
+    """Oy oxiriga SHEETS_PRECREATE_DAYS kun qolganda keyingi oy varag'ini oldindan yaratadi."""
+    today = datetime.now()
+    next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+    if (next_month.date() - today.date()).days <= SHEETS_PRECREATE_DAYS:
+        get_or_create_monthly_sheet(spreadsheet, monthly_sheet_title(next_month))
+
+def _fetch_or_create_monthly_sheet(spreadsheet: gspread.Spreadsheet, sheet_title: str) -> Optional[gspread.Worksheet]:
+    """Oylik varaqni Sheetsdan topadi yoki yaratadi (faqat kesh topilmaganda chaqiriladi)."""
     try:
         # 1. Mavjud varaqni topishga urinish
         worksheet = spreadsheet.worksheet(sheet_title)
@@ -60,7 +216,12 @@ def get_or_create_monthly_sheet(spreadsheet: gspread.Spreadsheet) -> gspread.Wor
         logging.info(f"Varaq topilmadi, {sheet_title} yaratilmoqda...")
         
         # Yangi varaqni yaratish
-        worksheet = spreadsheet.add_worksheet(title=sheet_title, rows=1000, cols=15)
+        try:
+            worksheet = spreadsheet.add_worksheet(title=sheet_title, rows=1000, cols=15)
+        except gspread.exceptions.APIError as e:
+            # Boshqa jarayon varaqni ayni paytda yaratib ulgurgan bo'lishi mumkin
+            if "already exists" not in str(e): raise
+            return spreadsheet.worksheet(sheet_title)
         
         # Sarlavha qatorini qo'shish
         header = [
@@ -77,98 +238,65 @@ def get_or_create_monthly_sheet(spreadsheet: gspread.Spreadsheet) -> gspread.Wor
         return None
 
 # ==============================================================================
-# III. MA'LUMOT KIRITISH (SINXRON) FUNKSIYALARI - o'zgarmadi
+# III. MA'LUMOT KIRITISH (SINXRON) FUNKSIYALARI - outbox fon vazifasi chaqiradi
 # ==============================================================================
 
-def write_stock_txn_to_sheets_sync(agent_name: str, product_name: str, qty_kg: float, issue_price: float, total_cost: float) -> bool:
-    """Agentga berilgan tovar (stok) amaliyotini Sheetsga yozadi."""
-    spreadsheet = get_sheets_client()
-    if not spreadsheet: return False
-
-    try:
-        worksheet = spreadsheet.worksheet(SHEET_NAMES["STOCK"])
-        now = datetime.now()
-        row = [
-            now.strftime("%Y-%m-%d %H:%M:%S"),
-            agent_name,
-            product_name,
-            qty_kg,
-            issue_price,
-            total_cost
-        ]
-        worksheet.append_row(row)
-        return True
-    except Exception as e:
-        logging.error(f"Stok tranzaksiyasini Sheetsga yozishda xato: {e}")
-        return False
-
-def write_debt_txn_to_sheets_sync(agent_name: str, txn_type: str, amount: float, txn_date: str, comment: str) -> bool:
-    """Agentning pul to'lovi yoki avans amaliyotini Sheetsga yozadi."""
-    spreadsheet = get_sheets_client()
-    if not spreadsheet: return False
+def build_stock_row(agent_name: str, product_name: str, qty_kg: float, issue_price: float, total_cost: float) -> list:
+    """STOK_JAMI varag'i uchun qatorni shakllantiradi."""
+    now = datetime.now()
+    return [
+        now.strftime("%Y-%m-%d %H:%M:%S"),
+        agent_name,
+        product_name,
+        qty_kg,
+        issue_price,
+        total_cost
+    ]
 
-    try:
-        worksheet = spreadsheet.worksheet(SHEET_NAMES["DEBT"])
-        row = [
-            txn_date,
-            agent_name,
-            txn_type,
-            amount, # Manfiy yoki Musbat qiymat
-            comment
-        ]
-        worksheet.append_row(row)
-        return True
-    except Exception as e:
-        logging.error(f"Qarz tranzaksiyasini Sheetsga yozishda xato: {e}")
-        return False
+def build_debt_row(agent_name: str, txn_type: str, amount: float, txn_date: str, comment: str) -> list:
+    """QARZDORLIK_JAMI varag'i uchun qatorni shakllantiradi."""
+    return [
+        txn_date,
+        agent_name,
+        txn_type,
+        amount, # Manfiy yoki Musbat qiymat
+        comment
+    ]
 
+def build_sale_row(agent_name: str, product_name: str, qty_kg: float, sale_price: float, total_amount: float, sale_date: str, sale_time: str) -> list:
+    """Oylik savdo varag'i uchun qatorni shakllantiradi."""
+    return [
+        sale_date,
+        sale_time,
+        agent_name,
+        product_name,
+        qty_kg,
+        sale_price,
+        total_amount
+    ]
 
-def write_sale_to_sheets_sync(agent_name: str, product_name: str, qty_kg: float, sale_price: float, total_amount: float, sale_date: str, sale_time: str) -> bool:
-    """Agentning savdo tranzaksiyasini dinamik oylik Sheets varag'iga yozadi."""
+def append_rows_batch_sync(batches: Dict[str, List[list]]) -> Dict[str, List[list]]:
+    """
+    Varaq nomi bo'yicha guruhlangan qatorlarni har bir varaqqa bitta append_rows bilan yozadi.
+    Yozilmay qolgan (xato bergan) varaqlarning qatorlarini qaytaradi.
+    """
     spreadsheet = get_sheets_client()
-    if not spreadsheet: return False
+    if not spreadsheet: return batches
 
     try:
-        worksheet = get_or_create_monthly_sheet(spreadsheet)
-        if not worksheet: return False
-        
-        row = [
-            sale_date,
-            sale_time,
-            agent_name,
-            product_name,
-            qty_kg,
-            sale_price,
-            total_amount
-        ]
-        worksheet.append_row(row)
-        return True
+        ensure_next_month_sheet(spreadsheet)
     except Exception as e:
-        logging.error(f"Savdo tranzaksiyasini Sheetsga yozishda xato: {e}")
-        return False
+        logging.warning(f"Keyingi oy varag'ini oldindan yaratib bo'lmadi: {e}")
 
-# ==============================================================================
-# IV. ASINXRON PROKSI (PROXY) FUNKSIYALARI
-# ==============================================================================
-# Boshqa fayllar endi faqat quyidagi funksiyalarni chaqirishi kerak.
-
-async def write_stock_txn_to_sheets(agent_name: str, product_name: str, qty_kg: float, issue_price: float, total_cost: float) -> bool:
-    """Sinxron stok yozish funksiyasini bloklanmasdan chaqiradi."""
-    return await asyncio.to_thread(
-        write_stock_txn_to_sheets_sync, 
-        agent_name, product_name, qty_kg, issue_price, total_cost
-    )
-
-async def write_debt_txn_to_sheets(agent_name: str, txn_type: str, amount: float, txn_date: str, comment: str) -> bool:
-    """Sinxron pul harakati funksiyasini bloklanmasdan chaqiradi."""
-    return await asyncio.to_thread(
-        write_debt_txn_to_sheets_sync, 
-        agent_name, txn_type, amount, txn_date, comment
-    )
-
-async def write_sale_to_sheets(agent_name: str, product_name: str, qty_kg: float, sale_price: float, total_amount: float, sale_date: str, sale_time: str) -> bool:
-    """Sinxron savdo yozish funksiyasini bloklanmasdan chaqiradi."""
-    return await asyncio.to_thread(
-        write_sale_to_sheets_sync, 
-        agent_name, product_name, qty_kg, sale_price, total_amount, sale_date, sale_time
-    )
+    failed = {}
+    for sheet_title, rows in batches.items():
+        try:
+            if not append_rows_to_sheet(spreadsheet, sheet_title, rows):
+                failed[sheet_title] = rows
+                continue
+            logging.info(f"{sheet_title} varag'iga {len(rows)} ta qator yozildi.")
+        except Exception as e:
+            logging.error(f"{sheet_title} varag'iga paketli yozishda xato: {e}")
+            sheets_client.invalidate_on_auth_error(e)
+            failed[sheet_title] = rows
+    return failed
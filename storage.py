@@ -0,0 +1,280 @@
+# ==============================================================================
+# storage.py
+# FSM (Holat Mashinasi) saqlash backendlarini tanlash
+# ==============================================================================
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Optional
+
+from aiogram.fsm.state import State
+import asyncpg
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+
+from collections import OrderedDict
+
+import database
+from config import FSM_STORAGE, REDIS_URL, FSM_SQLITE_PATH, FSM_LOCK_RETRY, DATABASE_DIRECT_URL
+
+
+def build_storage_key(key: StorageKey) -> str:
+    """StorageKey dan barcha backendlar uchun yagona satr kalit yasaydi."""
+    parts = [
+        key.bot_id,
+        key.chat_id,
+        key.user_id,
+        getattr(key, "thread_id", None) or "",
+        getattr(key, "business_connection_id", None) or "",
+        key.destiny,
+    ]
+    return ":".join(str(part) for part in parts)
+
+
+def state_to_str(state: StateType) -> Optional[str]:
+    """State obyekti yoki satrni saqlanadigan satrga aylantiradi."""
+    return state.state if isinstance(state, State) else state
+
+
+# ==============================================================================
+# I. SQLITE SAQLASH (Lokal / test uchun Redis o'rnini bosuvchi)
+# ==============================================================================
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM holati va ma'lumotlarini SQLite faylida saqlaydi.
+    Restartdan keyin ham tugallanmagan jarayonlar saqlanib qoladi; bitta server uchun mo'ljallangan.
+    """
+
+    def __init__(self, path: str = FSM_SQLITE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                storage_key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        with self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+            self._conn.commit()
+            return row
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await asyncio.to_thread(self._execute, """
+            INSERT INTO fsm_storage (storage_key, state) VALUES (?, ?)
+            ON CONFLICT (storage_key) DO UPDATE SET state = excluded.state
+        """, (build_storage_key(key), state_to_str(state)))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await asyncio.to_thread(
+            self._execute, "SELECT state FROM fsm_storage WHERE storage_key = ?", (build_storage_key(key),)
+        )
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._execute, """
+            INSERT INTO fsm_storage (storage_key, data) VALUES (?, ?)
+            ON CONFLICT (storage_key) DO UPDATE SET data = excluded.data
+        """, (build_storage_key(key), json.dumps(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await asyncio.to_thread(
+            self._execute, "SELECT data FROM fsm_storage WHERE storage_key = ?", (build_storage_key(key),)
+        )
+        return json.loads(row[0]) if row else {}
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# ==============================================================================
+# II. POSTGRESQL SAQLASH (mavjud asyncpg havzasi orqali)
+# ==============================================================================
+
+class FSMWriteBatch:
+    """Bitta update davomida PostgresStorage ga yozilgan yozuvlar (har bir kalit uchun oxirgi holat va ma'lumot)."""
+
+    def __init__(self):
+        self.records: Dict[str, tuple] = {}
+        self.open = True
+
+# Joriy update ning yozuvlar paketi (har bir update o'z kontekstida ishlaydi)
+_write_batch: ContextVar[Optional[FSMWriteBatch]] = ContextVar("fsm_write_batch", default=None)
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM holati va ma'lumotlarini Neon bazasidagi fsm_storage jadvalida saqlaydi (database.DB_POOL orqali).
+
+    Yozish: update ichida (batch_writes bloki, middlewares.FSMWriteBatchMiddleware) set_state, set_data va
+    update_data faqat keshni yangilaydi va yozuvni paketga qo'shadi; update tugaganda paket bitta upsert bilan
+    yoziladi. Bu events_isolation qulfi ichida bo'ladi, shuning uchun shu foydalanuvchining keyingi update'i
+    (boshqa workerda ham) yangi holatni o'qiydi. Blokdan tashqaridagi yozuvlar darhol (write-through) yoziladi.
+    O'qish: get_state har update boshida holat va ma'lumotni birga o'qiydi, keyingi get_data keshdan olinadi.
+    """
+
+    def __init__(self, cache_size: int = 10000):
+        self.cache_size = cache_size
+        # storage_key -> {'state': ..., 'data': ...}
+        self._cache: OrderedDict = OrderedDict()
+
+    def _remember(self, storage_key: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        self._cache[storage_key] = {'state': state, 'data': data}
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, storage_key: str) -> Dict[str, Any]:
+        record = await database.fetch_fsm_record(storage_key)
+        state, data = (record['state'], record['data']) if record else (None, {})
+        self._remember(storage_key, state, data)
+        return self._cache[storage_key]
+
+    async def _save(self, storage_key: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        batch = _write_batch.get()
+        if batch is not None and batch.open:
+            batch.records[storage_key] = (storage_key, state, data)
+            self._remember(storage_key, state, data)
+            return
+        # Bazaga yozilmasa kesh ham yangilanmaydi (xato chaqiruvchiga uzatiladi)
+        await database.upsert_fsm_records([(storage_key, state, data)])
+        self._remember(storage_key, state, data)
+
+    @asynccontextmanager
+    async def batch_writes(self) -> AsyncIterator[None]:
+        """Blok ichidagi barcha yozuvlarni yig'ib, blok tugaganda (xato bo'lsa ham) bitta upsert bilan yozadi."""
+        batch = FSMWriteBatch()
+        token = _write_batch.set(batch)
+        try:
+            yield
+        finally:
+            batch.open = False
+            _write_batch.reset(token)
+            if batch.records:
+                try:
+                    await database.upsert_fsm_records(list(batch.records.values()))
+                except Exception:
+                    # Yozilmagan qiymatlar keshda qolmasin: keyingi o'qish bazadan bo'ladi
+                    for storage_key in batch.records:
+                        self._cache.pop(storage_key, None)
+                    raise
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = build_storage_key(key)
+        cached = self._cache.get(storage_key) or await self._load(storage_key)
+        await self._save(storage_key, state_to_str(state), cached['data'])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        storage_key = build_storage_key(key)
+        # Har bir update boshida bazadan yangilanadi (boshqa replikalar o'zgartirgan bo'lishi mumkin)
+        return (await self._load(storage_key))['state']
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = build_storage_key(key)
+        cached = self._cache.get(storage_key) or await self._load(storage_key)
+        await self._save(storage_key, cached['state'], dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        storage_key = build_storage_key(key)
+        cached = self._cache.get(storage_key) or await self._load(storage_key)
+        return dict(cached['data'])
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+class PostgresEventIsolation(BaseEventIsolation):
+    """
+    Bir foydalanuvchining update'larini barcha workerlar bo'ylab navbatga qo'yadi (FSM_STORAGE=postgres).
+    Avval jarayon ichidagi qulf (SimpleEventIsolation), so'ng build_storage_key bo'yicha pg_try_advisory_lock olinadi;
+    qulf boshqa workerda band bo'lsa FSM_LOCK_RETRY soniyadan keyin qayta uriniladi.
+    Sessiya qulflari ulanishga bog'langani uchun ular havzadan emas, DATABASE_DIRECT_URL ga ochilgan bitta
+    alohida ulanishda olinadi (pgbouncer transaction rejimida sessiya qulflari ishlamaydi).
+    """
+
+    LOCK_SQL = "SELECT pg_try_advisory_lock(hashtextextended($1, 0));"
+    UNLOCK_SQL = "SELECT pg_advisory_unlock(hashtextextended($1, 0));"
+
+    def __init__(self, retry_interval: float = FSM_LOCK_RETRY):
+        self._local = SimpleEventIsolation()
+        self._retry_interval = retry_interval
+        self._conn: Optional[asyncpg.Connection] = None
+        # Bitta ulanishda bir vaqtda faqat bitta so'rov bajariladi
+        self._conn_lock = asyncio.Lock()
+
+    async def _fetchval(self, sql: str, storage_key: str) -> Any:
+        async with self._conn_lock:
+            if self._conn is None or self._conn.is_closed():
+                # Ulanish uzilsa, undagi qulflar Postgres tomonidan bo'shatilgan bo'ladi
+                self._conn = await asyncpg.connect(DATABASE_DIRECT_URL)
+            return await self._conn.fetchval(sql, storage_key)
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncIterator[None]:
+        storage_key = build_storage_key(key)
+        async with self._local.lock(key):
+            while not await self._fetchval(self.LOCK_SQL, storage_key):
+                await asyncio.sleep(self._retry_interval)
+            try:
+                yield
+            finally:
+                try:
+                    await self._fetchval(self.UNLOCK_SQL, storage_key)
+                except Exception as e:
+                    logging.error(f"FSM qulfini ({storage_key}) bo'shatishda xato: {e}")
+
+    async def close(self) -> None:
+        await self._local.close()
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+        self._conn = None
+
+
+# ==============================================================================
+# III. BACKENDNI TANLASH
+# ==============================================================================
+
+def build_fsm_storage(backend: str = FSM_STORAGE) -> BaseStorage:
+    """FSM_STORAGE sozlamasiga ko'ra saqlash backendini yaratadi."""
+    if backend == "redis":
+        # Ixtiyoriy bog'liqlik: faqat Redis tanlanganda import qilinadi
+        from aiogram.fsm.storage.redis import RedisStorage
+        logging.info("FSM saqlash: Redis")
+        return RedisStorage.from_url(REDIS_URL)
+
+    if backend == "postgres":
+        logging.info("FSM saqlash: PostgreSQL (fsm_storage jadvali)")
+        return PostgresStorage()
+
+    if backend == "sqlite":
+        logging.info(f"FSM saqlash: SQLite ({FSM_SQLITE_PATH})")
+        return SQLiteStorage(FSM_SQLITE_PATH)
+
+    if backend != "memory":
+        logging.warning(f"Noma'lum FSM_STORAGE qiymati: {backend}. Xotira (memory) ishlatiladi.")
+    logging.info("FSM saqlash: xotira (faqat bitta jarayon)")
+    return MemoryStorage()
+
+
+def build_events_isolation(storage: BaseStorage) -> BaseEventIsolation:
+    """
+    Saqlash backendiga mos events_isolation yaratadi: bir foydalanuvchining update'lari FSM holati o'qilishidan
+    OLDIN qulflanadi. Redis va Postgres qulflari barcha workerlar uchun, qolganlari faqat shu jarayon uchun.
+    """
+    if isinstance(storage, PostgresStorage):
+        return PostgresEventIsolation()
+    # RedisStorage o'z qulfini beradi (RedisEventIsolation)
+    create_isolation = getattr(storage, "create_isolation", None)
+    if create_isolation is not None:
+        return create_isolation()
+    return SimpleEventIsolation()